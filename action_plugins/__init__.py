@@ -0,0 +1,5 @@
+'''
+Action plugins that run modules from library/ on the controller.
+
+See `Ansible Documentation <http://docs.ansible.com/ansible/dev_guide/developing_plugins.html#action-plugins>`_ for how action plugins work.
+'''
@@ -0,0 +1,180 @@
+'''
+ Runs the configsort module in-process on the controller.
+
+ config_sort is often run against files on the controller, with a local
+ connection or ``delegate_to: localhost``. Run as a normal module, every
+ host still pays for packaging the module, starting a new Python process
+ and sending its result (including any diff) back. When the task's
+ connection is local, this plugin skips all of that and calls the
+ module's code directly, so the per-host cost is just the sort itself.
+
+ Any other connection runs the module on the target host as usual, as
+ do ``remote_src=yes``, ``become`` (so files are read and written as the
+ become user) and ``async`` tasks. It takes the same options as the module.
+
+ The module itself is found through Ansible's module path, so
+ configsort.py must be installed as a module (e.g. in a library/
+ directory next to the playbook) wherever this plugin is used.
+'''
+from __future__ import absolute_import
+
+import os
+import sys
+
+from ansible import errors
+from ansible.plugins.action import ActionBase
+
+try:
+    from ansible.module_utils.parsing.convert_bool import boolean
+except ImportError:
+    ## Ansible < 2.4
+    from ansible.utils.boolean import boolean
+
+try:
+    from importlib.util import spec_from_file_location, module_from_spec
+except ImportError:
+    ## Python 2
+    import imp
+    spec_from_file_location = None
+
+## Name the configsort module is imported under.
+_MODULE_NAME = 'ansible_misc_configsort'
+## Names of the local connection plugin, short and fully qualified.
+_LOCAL_CONNECTIONS = ('local', 'ansible.builtin.local', 'ansible.legacy.local')
+
+def _configsort():
+    '''
+    Import the configsort module from Ansible's module path, so that it is
+    found wherever Ansible would run it from (a library/ directory next to
+    the playbook or in a role, ANSIBLE_LIBRARY, ...). If it isn't in the
+    module path, the library/ directory next to this plugin's directory
+    is tried, as laid out in this repository.
+
+    Returns:
+        module: The configsort module.
+
+    Raises:
+        AnsibleError: If the module can't be found.
+    '''
+    if _MODULE_NAME in sys.modules:
+        return sys.modules[_MODULE_NAME]
+    try:
+        from ansible.plugins.loader import module_loader
+    except ImportError:
+        ## Ansible < 2.4
+        from ansible.plugins import module_loader
+    try:
+        path = module_loader.find_plugin('configsort', mod_type='.py')
+    except Exception:
+        ## Outside a running Ansible, ansible-core >= 2.10 can't import
+        ## its collection loader, so the module path can't be searched.
+        path = None
+    if not path:
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'library', 'configsort.py')
+    if not os.path.isfile(path):
+        raise errors.AnsibleError('the configsort module was not found in the module path')
+    if spec_from_file_location is None:
+        return imp.load_source(_MODULE_NAME, path)
+    spec = spec_from_file_location(_MODULE_NAME, path)
+    module = module_from_spec(spec)
+    ## Registered before it runs, so its functions can be pickled for
+    ## the worker processes it starts.
+    sys.modules[_MODULE_NAME] = module
+    try:
+        spec.loader.exec_module(module)
+    except Exception:
+        del sys.modules[_MODULE_NAME]
+        raise
+    return module
+
+
+def _check_args(args):
+    '''
+    Applies the module's defaults and types to the task args, as
+    AnsibleModule would.
+
+    Args:
+        args (dict): Task args.
+
+    Returns:
+        tuple: (params, msg) where msg is None, or the reason the args are invalid.
+    '''
+    configsort = _configsort()
+    unknown = sorted(set(args) - set(configsort.ARGUMENT_SPEC))
+    if unknown:
+        return None, 'Unsupported parameters for configsort: %s' % ', '.join(unknown)
+    for names in configsort.REQUIRED_ONE_OF:
+        if not any(args.get(name) is not None for name in names):
+            return None, 'one of the following is required: %s' % ', '.join(names)
+    for names in configsort.MUTUALLY_EXCLUSIVE:
+        if len([name for name in names if args.get(name) is not None]) > 1:
+            return None, 'parameters are mutually exclusive: %s' % ', '.join(names)
+    params = {}
+    for name, spec in configsort.ARGUMENT_SPEC.items():
+        value = args.get(name)
+        if value is None:
+            params[name] = spec.get('default')
+            continue
+        try:
+            if spec.get('type') == 'bool':
+                value = boolean(value)
+            elif spec.get('type') == 'int':
+                value = int(value)
+            elif spec.get('type') == 'list' and not isinstance(value, list):
+                value = value.split(',')
+        except (TypeError, ValueError):
+            return None, 'argument %s is of type %s and we were unable to convert it' % (
+                name, spec['type'])
+        if 'choices' in spec and value not in spec['choices']:
+            return None, 'value of %s must be one of: %s, got: %s' % (
+                name, ', '.join(spec['choices']), value)
+        params[name] = value
+    return params, None
+
+
+class ActionModule(ActionBase):
+    ''' Runs configsort on the controller '''
+
+    TRANSFERS_FILES = False
+    _supports_check_mode = True
+    _supports_async = True
+
+    def _in_process(self, args):
+        ''' Whether the task can be run in-process instead of as a module '''
+        ## Only files on the controller can be sorted in-process, and only
+        ## as the controller user and in the foreground.
+        if boolean(args.pop('remote_src', False)):
+            return False
+        if self._play_context.connection not in _LOCAL_CONNECTIONS:
+            return False
+        return not self._play_context.become and not self._task.async_val
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+        result = super(ActionModule, self).run(tmp, task_vars)
+        args = self._task.args.copy()
+        if not self._in_process(args):
+            wrap_async = self._task.async_val and not self._connection.has_native_async
+            result.update(self._execute_module(module_args=args, task_vars=task_vars,
+                                               wrap_async=wrap_async))
+            if not wrap_async:
+                self._remove_tmp_path(self._connection._shell.tmpdir)
+            return result
+        try:
+            params, msg = _check_args(args)
+        except errors.AnsibleError as e:
+            params, msg = None, str(e)
+        if msg is not None:
+            result['failed'] = True
+            result['msg'] = msg
+            return result
+        try:
+            result.update(_configsort().run_module(
+                params, check_mode=self._play_context.check_mode,
+                diff=getattr(self._play_context, 'diff', False)))
+        except (IOError, OSError) as e:
+            result['failed'] = True
+            result['msg'] = str(e)
+        return result
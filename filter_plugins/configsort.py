@@ -0,0 +1,299 @@
+'''
+ This is a collection of filters that sort configuration text,
+ using the configsort module. The module is found through Ansible's
+ module path, or in the library/ directory of this repository.
+'''
+from __future__ import absolute_import
+
+from ansible import errors
+from collections import OrderedDict
+import errno
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+try:
+    from importlib.util import spec_from_file_location, module_from_spec
+except ImportError:
+    ## Python 2
+    import imp
+    spec_from_file_location = None
+
+try:
+    string_types = (basestring,)
+except NameError:
+    ## Python 3
+    string_types = (str,)
+
+## Name the configsort module is imported under. The configsort action
+## plugin uses the same name, so both plugins share one copy of it.
+_MODULE_NAME = 'ansible_misc_configsort'
+## Number of sorted configs kept by config_sort.
+CACHE_SIZE = 256
+## Number of files, markers included, kept in the shared cache. When it
+## is full, the least recently used entries are removed down to SHARED_KEEP.
+SHARED_SIZE = 1024
+SHARED_KEEP = SHARED_SIZE * 3 // 4
+
+## content hash -> sorted config, least recently used first.
+## This lives in the process that templates the task, so each forked
+## worker has its own; _shared_dir() is what the workers share.
+_cache = OrderedDict()
+
+def _configsort():
+    '''
+    Import the configsort module from Ansible's module path, or from the
+    library/ directory next to this plugin's directory, as laid out in
+    this repository. If the configsort action plugin already loaded it,
+    that copy is used.
+
+    Returns:
+        module: The configsort module.
+
+    Raises:
+        AnsibleError: If the module can't be found.
+    '''
+    if _MODULE_NAME in sys.modules:
+        return sys.modules[_MODULE_NAME]
+    try:
+        from ansible.plugins.loader import module_loader
+    except ImportError:
+        ## Ansible < 2.4
+        from ansible.plugins import module_loader
+    try:
+        path = module_loader.find_plugin('configsort', mod_type='.py')
+    except Exception:
+        ## Outside a running Ansible, ansible-core >= 2.10 can't import
+        ## its collection loader, so the module path can't be searched.
+        path = None
+    if not path:
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'library', 'configsort.py')
+    if not os.path.isfile(path):
+        raise errors.AnsibleError('the configsort module was not found in the module path')
+    if spec_from_file_location is None:
+        return imp.load_source(_MODULE_NAME, path)
+    spec = spec_from_file_location(_MODULE_NAME, path)
+    module = module_from_spec(spec)
+    sys.modules[_MODULE_NAME] = module
+    try:
+        spec.loader.exec_module(module)
+    except Exception:
+        del sys.modules[_MODULE_NAME]
+        raise
+    return module
+
+def _shared_dir():
+    '''
+    Directory for sorted configs shared by all the forked workers of a run.
+    This is Ansible's local temp dir, which the main process creates once
+    per run and removes when the run ends.
+
+    Returns:
+        str: The directory, or None if there isn't one.
+    '''
+    try:
+        from ansible import constants as C
+        return os.path.join(C.DEFAULT_LOCAL_TMP, 'config_sort')
+    except Exception:
+        return None
+
+
+def _load_shared(name):
+    '''
+    Reads a sorted config from the shared cache.
+
+    Args:
+        name (str): File name of the entry.
+
+    Returns:
+        str or list: The sorted config, or None if it isn't cached.
+    '''
+    shared = _shared_dir()
+    if shared is None:
+        return None
+    path = os.path.join(shared, name)
+    try:
+        with open(path) as _:
+            result = json.load(_)
+    except (IOError, OSError, ValueError):
+        return None
+    try:
+        ## Keeps the entry from being evicted as least recently used.
+        os.utime(path, None)
+    except OSError:
+        pass
+    return result
+
+
+def _evict_shared(shared):
+    '''
+    Removes the least recently used entries, markers included, once the
+    shared cache holds SHARED_SIZE files, leaving SHARED_KEEP of them.
+    Temporary files being written by other workers are left alone.
+
+    Args:
+        shared (str): The shared cache directory.
+    '''
+    entries = []
+    for name in os.listdir(shared):
+        if name.startswith('.'):
+            continue
+        path = os.path.join(shared, name)
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except OSError:
+            ## Removed by another worker.
+            pass
+    if len(entries) < SHARED_SIZE:
+        return
+    entries.sort()
+    for _, path in entries[:len(entries) - SHARED_KEEP]:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def _save_shared(name, result):
+    '''
+    Writes a sorted config to the shared cache, the second time a worker
+    sorts it. The first time only an empty marker file is left, so configs
+    that are unique to one host, the common case, are not written out.
+    Once the cache holds SHARED_SIZE files the least recently used ones
+    are evicted (see _evict_shared).
+
+    Entries are renamed into place, so other workers never read one half
+    written. Failures are ignored, the cache is only an optimization.
+
+    Args:
+        name (str): File name of the entry.
+        result (str or list): The sorted config.
+    '''
+    shared = _shared_dir()
+    if shared is None:
+        return
+    try:
+        if not os.path.isdir(shared):
+            try:
+                os.makedirs(shared)
+            except OSError:
+                ## Made by another worker in the meantime.
+                if not os.path.isdir(shared):
+                    raise
+        _evict_shared(shared)
+        try:
+            os.close(os.open(os.path.join(shared, name + '.seen'),
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            ## No other worker has sorted this config yet.
+            return
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmppath = tempfile.mkstemp(dir=shared, prefix='.%s.' % name, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as _:
+                json.dump(result, _)
+            os.rename(tmppath, os.path.join(shared, name))
+        except Exception:
+            os.unlink(tmppath)
+            raise
+    except (IOError, OSError, TypeError, ValueError):
+        pass
+
+
+class FilterModule(object):
+    ''' Class to make filters available to Ansible '''
+
+    def filters(self):
+        ''' List of filters to import into Ansible '''
+        return {
+            'config_sort': config_sort,
+        }
+
+def config_sort(stuff, order='lexical'):
+    '''
+    config_sort will sort configuration text while maintaining hierarchy,
+    the same way the config_sort module sorts a file.
+
+        | Results are cached, keyed by a hash of the text, so a config block
+        | shared by many hosts is only sorted about once per run. Ansible
+        | templates each host in its own forked worker. The last CACHE_SIZE
+        | results are kept in memory for the rest of the worker's loop, and
+        | configs sorted by more than one worker are also kept in a file in
+        | Ansible's local temp dir for the other workers (see _save_shared).
+
+        | The configsort module itself is found in Ansible's module path,
+        | like any other module (e.g. a library/ directory next to the
+        | playbook), or in this repository's library/ directory.
+
+    Args:
+        stuff (str or list): Config as a string, or lines, as a list or any other
+            iterable such as the output of ``map``. Usually, this passed via pipe.
+        order (Optional[str]): How lines at each level are ordered. Defaults to 'lexical'.
+
+            Options: [ 'lexical', 'natural' ]
+
+    Returns:
+        str or list: The sorted config, a string if stuff is one, else a list.
+
+            | A string keeps its trailing newline, if it had one.
+
+    Example:
+        Playbook Example::
+
+            ---
+            tasks:
+            - name: render the golden config
+              copy:
+                content="{{ lookup('template', 'golden.j2')|config_sort }}"
+                dest="golden/{{ inventory_hostname }}.conf"
+            - name: sort the lines of a running config
+              debug:
+                msg="{{ running.stdout_lines|reject('match', '^!')|config_sort }}"
+    '''
+    try:
+        configsort = _configsort()
+    except errors.AnsibleError as e:
+        raise errors.AnsibleFilterError('config_sort: %s' % e)
+    if order not in configsort.SORT_ORDERS:
+        raise errors.AnsibleFilterError('config_sort: unknown order %r, expected one of %s' % (
+            order, ', '.join(sorted(configsort.SORT_ORDERS))))
+    is_text = isinstance(stuff, string_types)
+    if not is_text:
+        ## Generators, e.g. from map or select, can only be read once.
+        stuff = list(stuff)
+    digest = hashlib.sha1()
+    if is_text:
+        digest.update(configsort._to_bytes(stuff))
+    else:
+        ## Lines are hashed with a separator, so ['ab'] and ['a', 'b'] differ.
+        for line in stuff:
+            digest.update(configsort._to_bytes(line))
+            digest.update(b'\0')
+    key = (digest.digest(), order, is_text)
+    name = '%s.%s.%s.json' % (digest.hexdigest(), order, 'text' if is_text else 'lines')
+    result = _cache.pop(key, None)
+    if result is None:
+        result = _load_shared(name)
+        if result is not None and not is_text:
+            result = tuple(result)
+    if result is None:
+        if is_text:
+            ## Lines are sorted without their newlines, so a last line
+            ## without one can't end up glued to the next.
+            result = '\n'.join(configsort.sort_config(stuff.splitlines(), order))
+            if result and stuff.endswith('\n'):
+                result += '\n'
+        else:
+            result = tuple(configsort.sort_config(stuff, order))
+        _save_shared(name, result)
+    if len(_cache) >= CACHE_SIZE:
+        _cache.popitem(last=False)
+    _cache[key] = result
+    if is_text:
+        return result
+    ## Return a new list, so the cached copy can't be changed by the caller.
+    return list(result)
@@ -14,6 +14,9 @@ class FilterModule(object):
             'pluck': pluck,
             'stitch': stitch,
             'merge': merge,
+            'merge_many': merge_many,
+            'group_by': group_by,
+            'index_by': index_by,
         }
 
 def pluck(stuff, attr, val):
@@ -67,6 +70,119 @@ def pluck(stuff, attr, val):
     '''
     return [s for s in stuff if s.get(attr) == val]
 
+def group_by(stuff, attr, sep=None):
+    '''
+    group_by will split a list of dicts into a dict of lists, keyed by
+    the value of the attr field, in a single pass.
+
+        | ``(stuff|group_by(attr))[val]`` holds the same dicts as ``stuff|pluck(attr, val)``,
+        | so looking up every value in a loop doesn't rescan the whole list each time.
+
+    Args:
+        stuff (list): List of dicts to group. Usually, this passed via pipe.
+        attr (str): Attribute to group by. Dicts without it are left out.
+        attr (list): Attributes to group by together. The key is a tuple of
+            their values (or a string, see sep). Dicts missing any of them are left out.
+        sep (Optional[str]): Join the values of a list of attrs into a string key
+            with this separator, e.g. for use with set_fact, where keys must be strings.
+
+    Returns:
+        dict: Value of attr -> list of the dicts with that value, in their original order.
+
+    Example:
+        Playbook Example::
+
+            ---
+            vars:
+              ports:
+                - { name: ge-0/0/0, vlan: 10, mode: access }
+                - { name: ge-0/0/1, vlan: 20, mode: access }
+                - { name: ge-0/0/2, vlan: 10, mode: access }
+
+            tasks:
+            - name: group the ports once
+              set_fact:
+                ports_by_vlan: "{{ ports|group_by('vlan') }}"
+                ports_by_vlan_mode: "{{ ports|group_by(['vlan','mode'],'/') }}"
+
+            - name: show the ports in each vlan
+              debug: msg="vlan {{ item }} is on {{ ports_by_vlan[item]|map(attribute='name')|join(',') }}"
+              with_items: "{{ vlans }}"
+
+            - name: show the access ports in vlan 10
+              debug: var=ports_by_vlan_mode['10/access']
+    '''
+    key = _keyfunc(attr, sep)
+    ret = {}
+    for s in stuff:
+        try:
+            k = key(s)
+        except KeyError:
+            continue
+        try:
+            ret.setdefault(k, []).append(s)
+        except TypeError:
+            raise errors.AnsibleFilterError('group_by: %r can not be used as a key' % (k,))
+    return ret
+
+def index_by(stuff, attr, sep=None):
+    '''
+    index_by will turn a list of dicts into a dict keyed by the value of
+    the attr field, for when that value is unique.
+
+    Args:
+        stuff (list): List of dicts to index. Usually, this passed via pipe.
+        attr (str or list): Attribute, or list of attributes, to index by.
+            As for group_by().
+        sep (Optional[str]): As for group_by().
+
+    Returns:
+        dict: Value of attr -> the dict with that value.
+
+    Raises:
+        AnsibleFilterError: If two dicts have the same value.
+
+    Example:
+        Playbook Example::
+
+            ---
+            tasks:
+            - name: index the ports once
+              set_fact:
+                ports_by_name: "{{ ports|index_by('name') }}"
+
+            - name: show the vlan of each port in the config
+              debug: msg="{{ item }} is in vlan {{ ports_by_name[item].vlan }}"
+              with_items: "{{ configured_ports }}"
+    '''
+    key = _keyfunc(attr, sep)
+    ret = {}
+    for s in stuff:
+        try:
+            k = key(s)
+        except KeyError:
+            continue
+        try:
+            if k in ret:
+                raise errors.AnsibleFilterError('index_by: more than one item has %s == %r' % (attr, k))
+            ret[k] = s
+        except TypeError:
+            raise errors.AnsibleFilterError('index_by: %r can not be used as a key' % (k,))
+    return ret
+
+def _keyfunc(attr, sep=None):
+    '''
+    Build the function group_by() and index_by() use to find the key of a dict.
+
+    Returns:
+        function: Returns the key of a dict, or raises KeyError if an attr is missing.
+    '''
+    if not isinstance(attr, (list, tuple)):
+        return lambda s: s[attr]
+    if sep is None:
+        return lambda s: tuple(s[a] for a in attr)
+    return lambda s: sep.join('%s' % (s[a],) for a in attr)
+
 def stitch(stuff, data, attr=None):
     '''
     Stitch will take a list of labels and map each to a dicts.
@@ -280,11 +396,83 @@ def merge(stuff, data, attr, filter=False):
                 with_items:
                   interfaces|merge(int_defs,'label')|merge(int_config,'name')
 
+        See merge_many() to do chained merges like this one in a single pass.
+
+    '''
+    return list(_merge_iter(stuff, data, attr, filter))
+
+def merge_many(stuff, stages):
     '''
+    Merge several lists of dicts into stuff in a single pass.
+
+    ``stuff|merge_many([[data1, attr1], [data2, attr2]])`` returns the same
+    list as ``stuff|merge(data1, attr1)|merge(data2, attr2)``, but each
+    item goes through all the merges before the next one is read, so no
+    intermediate lists are built. Dicts created by one merge are updated
+    in place by the next one instead of being copied again.
+
+    Args:
+        stuff (list): Initial list of stuff. Usually, this passed via pipe.
+        stages (list): The merges to do, in order. Each one is a list of
+            the ``data`` and ``attr`` arguments of merge(), optionally
+            followed by its ``filter`` argument.
+
+    Returns:
+        list: Merged list of dicts.
+
+    Example:
+        3-way merge, as in the merge() example::
+
+            ---
+            tasks:
+              - name: display merged interfaces
+                debug: var=item
+                with_items:
+                  interfaces|merge_many([[int_defs,'label'], [int_config,'name']])
+
+    '''
+    ## ids of the dicts created by the merges that are on their way to the
+    ## next stage. Nothing outside of this call refers to them, so that
+    ## stage may change them in place.
+    owned = set()
+    items = stuff
+    for stage in stages:
+        items = _merge_iter(items, *stage, owned=owned)
     retlist = []
-    merged = []
+    for d in items:
+        owned.discard(id(d))
+        retlist.append(d)
+    return retlist
+
+def _merge_iter(stuff, data, attr, filter=False, owned=None):
+    '''
+    Generator version of merge().
+
+    Args:
+        stuff, data, attr, filter: As for merge().
+        owned (Optional[set]): ids of dicts in stuff that were created by a
+            previous merge and can be updated in place rather than copied.
+            Each id is removed when its dict is read, and the ids of the dicts
+            yielded that can be changed by the next merge are added.
+            If None, nothing is updated in place.
+
+    Yields:
+        dict: Each item of the merged list.
+    '''
+    ## ids of the dicts that were merged. Dicts are tracked by identity,
+    ## since comparing whole dicts against a list of them is quadratic.
+    merged = set()
+    is_dict = 'keys' in dir(data)
+    if not is_dict:
+        ## If data is a list of dicts, then the labels are attributes
+        ## of the dicts. Index them by label once, instead of scanning
+        ## data for every /s/.
+        index = _index(data, attr)
     for s in stuff:
         label = s
+        mine = owned is not None and id(s) in owned
+        if mine:
+            owned.discard(id(s))
         ## If attr is specified, matching label is value of attr field.
         ## otherwise, assume stuff is a list of labels.
         if attr is not None:
@@ -297,43 +485,92 @@ def merge(stuff, data, attr, filter=False):
                 ## - or add /s/ to return val and move on to the next /s/.
                 if filter:
                     continue
-                newd = {}
-                newd.update(s)
-                retlist.append(newd)
+                if not mine:
+                    newd = {}
+                    newd.update(s)
+                    s = newd
+                if owned is not None:
+                    owned.add(id(s))
+                yield s
                 continue
         ## Find a list of dicts that match the key:val pairing for s.
         ## datalist[] should be a list of dicts (d) where d[attr] == label
-        if 'keys' in dir(data):
+        if is_dict:
             ## if data is a dict, assume that the keys are labels and
             ## the values are lists that need to be merged into stuff. 
             datalist = data.get(label,[])
         else:
-            ## If data is a list of dicts, then the labels are attributes 
-            ## of the dicts. 
-            datalist = [ d for d in data if d.get(attr,None) == label ]
+            datalist = _lookup(index, data, attr, label)
         if len(datalist) == 0:
             ## if datalist is empty, there is nothing to merge.
-            retlist.append(s)
+            if mine:
+                owned.add(id(s))
+            yield s
             continue
         ## Time to merge lists
         ## There might be multiple /d/ matches for each /s/
-        merged.append(s)
-        for d in datalist:
+        if not mine:
+            ## Only needed in case /s/ is also in data.
+            merged.add(id(s))
+        ## If /s/ is ours, the last match is merged into it in place,
+        ## after the copies for the other matches are made.
+        for d in (datalist[:-1] if mine else datalist):
             newd = {}
             newd.update(s)
             newd.update(d)
-            retlist.append(newd)
-            merged.append(d)
+            merged.add(id(d))
+            if owned is not None:
+                owned.add(id(newd))
+            yield newd
+        if mine:
+            d = datalist[-1]
+            s.update(d)
+            merged.add(id(d))
+            owned.add(id(s))
+            yield s
     if not filter:
-        if 'keys' in dir(data):
+        if is_dict:
             for k in data.keys():
                 for v in data[k]:
-                    if v not in merged:
+                    if id(v) not in merged:
                         v[attr] = k
-                        retlist.append(v)
+                        yield v
         else:
             for v in data:
-                if v not in merged:
-                    retlist.append(v)
-    return retlist
+                if id(v) not in merged:
+                    yield v
 
+def _index(data, attr):
+    '''
+    Index a list of dicts by the value of their attr field.
+
+    Args:
+        data (list): List of dicts.
+        attr (str): Attribute to index by.
+
+    Returns:
+        dict: Value of attr -> list of the dicts with that value, in the order
+            they appear in data. Dicts whose value can't be hashed are left out;
+            see _lookup().
+    '''
+    index = {}
+    for d in data:
+        try:
+            index.setdefault(d.get(attr,None), []).append(d)
+        except TypeError:
+            ## Unhashable value, e.g. a list.
+            pass
+    return index
+
+def _lookup(index, data, attr, label):
+    '''
+    Find the dicts in data where d[attr] == label, using an index from _index().
+
+    Returns:
+        list: Matching dicts, in the order they appear in data.
+    '''
+    try:
+        return index.get(label,[])
+    except TypeError:
+        ## An unhashable label can't be in the index, so fall back to a scan.
+        return [ d for d in data if d.get(attr,None) == label ]
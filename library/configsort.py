@@ -7,8 +7,14 @@ a diff between files from different generators.
 
 Args:
     src (str): The source file to sort.
-        This is usually the result of an assemble command
+        This is usually the result of an assemble command,
+        or can be the directory of fragments assemble would read.
     dest (str): The destination file to write sorted config.
+    pairs (list): src/dest dicts to sort in one invocation (batch mode).
+    glob (str): Batch mode: sort files matching this pattern in the src
+        directory into the dest directory.
+    workers (int): Number of processes used in batch mode, or to sort
+        the top-level sections of a single large src.
 
 Example:
     Playbook Example::
@@ -37,6 +43,14 @@ Note:
     This can be used to verify if, after moving or re-organizing roles and tasks,
     the final result is effectively unchanged.
 
+    Changes are detected by comparing a sha1 digest of the sorted output
+    with a digest of dest. The before/after diff is only returned when
+    Ansible is run with ``--diff``.
+
+    action_plugins/configsort.py runs this module in-process on the
+    controller instead of shipping it to each host. Put it in your
+    action_plugins path when src and dest live on the controller.
+
 """
 
 from __future__ import print_function, absolute_import
@@ -49,6 +63,13 @@ description:
   - The config_sort module sorts a configuration file 
     while maintaining hierarchy. This allows one to perform
     a diff between files from different generators.
+  - Files whose names end in C(.gz), C(.bz2) or C(.xz) are compressed.
+    This covers src, dest, C(compare) and the files of a batch. They are
+    decompressed and compressed as they are streamed, so no uncompressed
+    copy is written to disk. Changes are detected from the uncompressed
+    content, so compressing the same config again is not a change.
+    gzip files are written without a timestamp, and C(.xz) needs the
+    Python lzma module.
 version_added: 1.9
 category: System
 author: Mike Biancaniello (@chepazzo)
@@ -58,13 +79,180 @@ options:
     description:
       - Specify the source file to sort.
         This is usually the result of an assemble command
-    required: true
+      - If C(glob) is set, this is the directory to search for source files.
+      - Otherwise, if this is a directory, its files are fragments of the
+        config and are joined the way the assemble module does it (see
+        C(regexp) and C(ignore_hidden)). They are streamed straight into
+        the sort, so the assembled file is never written.
+      - Required unless C(pairs) is set.
+    required: false
     version_added: 1.9
   dest:
     description:
       - Specify the dest file to write sorted config.
-    required: true
+      - If C(glob) is set, this is the directory to write the sorted files to,
+        using the same path relative to it as the source has relative to C(src).
+      - Required unless C(pairs) is set.
+    required: false
     version_added: 1.9
+  regexp:
+    description:
+      - When src is a directory of fragments, only use the files whose
+        names match this regular expression, as in assemble.
+    required: false
+  ignore_hidden:
+    description:
+      - When src is a directory of fragments, skip files whose names
+        start with a C(.), as in assemble.
+    required: false
+    default: false
+    choices: [ "yes", "no" ]
+  structured_diff:
+    description:
+      - Compare the sorted output with dest hierarchically instead of as flat
+        text. The result gets a C(changes) list with the C(path) of parent
+        lines and the C(removed) and C(added) subtrees for every level that
+        changed. With C(--diff), the diff shown is a rendering of C(changes).
+    required: false
+    default: false
+    choices: [ "yes", "no" ]
+  compare:
+    description:
+      - Compare src with this config file instead of sorting it. Neither file
+        is sorted or written and dest is not needed; the result reports
+        C(changed=False).
+      - Every section is hashed bottom-up from its text and the hashes of its
+        sub lines, so sections that are the same apart from line order are
+        skipped whole. The result holds C(equivalent), up to 10
+        C(differences) (the C(path) of parent lines and the C(removed) and
+        C(added) lines at the first level that differs, with this file as the
+        removed side) and C(section_hashes), the hash of each top-level
+        section of src.
+    required: false
+  store:
+    description:
+      - Also save the sorted config in this content-addressed store
+        directory. Each top-level section is written once to
+        C(objects/<order>/), named after its hash (see C(compare)), and
+        C(manifests/<store_name>.json) lists the sections of this config.
+        Configs that share sections share their files, so the store for a
+        fleet grows with the number of unique sections.
+      - The result gets a C(store) dict with the C(manifest) path, the number
+        of C(sections) and how many of them were C(new) to the store.
+      - Not written in check mode.
+    required: false
+  store_name:
+    description:
+      - Name of this config's manifest in C(store). It can't contain a
+        path separator. Defaults to the file name of dest.
+      - In batch mode each file's manifest is named after its dest path,
+        relative to dest with C(glob), or to the directory the dest files of
+        C(pairs) have in common, so files of the same name in different
+        directories get their own manifests.
+    required: false
+  max_lines:
+    description:
+      - Sort with bounded memory. Once about this many lines are held,
+        the sorted top-level sections are spilled to a temporary file,
+        and the spilled runs are merged at the end. C(0) sorts in memory.
+      - Ignored when C(incremental) is set or C(workers) is greater than 1.
+    required: false
+    default: 0
+  tmpdir:
+    description:
+      - Directory for the temporary files used by C(max_lines).
+        Defaults to the system temp directory.
+    required: false
+  fsync:
+    description:
+      - dest is always written to a temporary file in the same directory and
+        renamed into place, so a crash never leaves a partial config.
+        With C(fsync), the file and directory are also flushed to disk
+        before the module returns.
+    required: false
+    default: false
+    choices: [ "yes", "no" ]
+  preserve:
+    description:
+      - Give the new dest the mode and owner of the file it replaces.
+        If C(no), or dest does not exist yet, it is created with the default
+        mode for the umask.
+    required: false
+    default: true
+    choices: [ "yes", "no" ]
+  stats:
+    description:
+      - Return a C(stats) dict in the result, with the C(timings) in seconds
+        of each stage (C(cache), C(state_load), C(parse), C(sort),
+        C(compare), C(diff), C(write), C(store), C(state_save)), C(lines_in), C(lines_out), the number of
+        top-level C(sections), C(max_depth), the C(widest) line and its
+        number of subs, C(bytes_read) and C(bytes_written).
+      - src is streamed into the parser, so reading it is timed as part of
+        C(parse). With C(incremental), C(workers) or C(max_lines), sorting
+        happens while parsing and is timed there too.
+    required: false
+    default: false
+    choices: [ "yes", "no" ]
+  pairs:
+    description:
+      - A list of dicts, each with a C(src) and a C(dest) key, to sort
+        in a single invocation. Mutually exclusive with C(src).
+      - The result holds a C(results) list with the C(changed) flag and
+        C(elapsed) seconds for each pair. Diffs are not returned in batch mode.
+    required: false
+  glob:
+    description:
+      - Sort every file in the C(src) directory matching this glob pattern
+        into the C(dest) directory. Results are returned as for C(pairs).
+    required: false
+  workers:
+    description:
+      - Number of processes used to sort files in batch mode.
+      - For a single src file, the number of processes its top-level
+        sections are sorted across. The output is the same as a serial
+        sort. Ignored when C(incremental) is set.
+    required: false
+    default: 1
+  parallel_threshold:
+    description:
+      - A single src with fewer lines than this is sorted serially even
+        if C(workers) is greater than 1.
+    required: false
+    default: 100000
+  order:
+    description:
+      - How lines at each level are ordered. C(lexical) compares plain text.
+        C(natural) compares runs of digits by value, so C(interface eth 2)
+        sorts before C(interface eth 10).
+    required: false
+    default: lexical
+    choices: [ "lexical", "natural" ]
+  cache:
+    description:
+      - Keep a sidecar cache file next to dest (dest + C(.sortcache)) that
+        records the size, mtime and sha1 of src and the sha1 of the sorted
+        output. If src and dest are unchanged since the last run, the
+        module returns changed=False without parsing src.
+    required: false
+    default: false
+    choices: [ "yes", "no" ]
+  incremental:
+    description:
+      - Keep a state file next to dest (dest + C(.sortstate)) with the sha1
+        and the sorted lines of every top-level section. On the next run,
+        sections of src whose sha1 is unchanged are copied from the state
+        instead of being sorted again, so only new or edited sections are
+        sorted. The output is the same as a full sort.
+      - The state file holds a second full copy of the sorted config (as
+        JSON), so it takes at least as much disk space as dest, and all of
+        it is loaded into memory on each run.
+      - The state is discarded if it was written with a different C(order)
+        (or C(regexp), C(ignore_hidden) or C(store)).
+        It is not written in check mode. C(workers) and C(max_lines) are
+        ignored when this is set.
+    required: false
+    default: false
+    choices: [ "yes", "no" ]
 """
 
 EXAMPLES = """
@@ -75,9 +263,68 @@ tasks:
       src="configs/{{ inventory_hostname }}.conf"
       dest="configs/{{ inventory_hostname }}.sorted.conf"
 
+  - name: assemble and sort the config fragments in one step
+    config_sort:
+      src="{{ config_dir }}/{{ inventory_hostname }}"
+      regexp="\\.fragment$"
+      dest="configs/{{ inventory_hostname }}.sorted.conf"
+
+  - name: sort config, skipping unchanged sources
+    config_sort:
+      src="configs/{{ inventory_hostname }}.conf"
+      dest="configs/{{ inventory_hostname }}.sorted.conf"
+      cache=yes
+
+  - name: check that the generated config matches the running config
+    config_sort:
+      src="configs/{{ inventory_hostname }}.conf"
+      compare="running/{{ inventory_hostname }}.conf"
+    register: compared
+    failed_when: not compared.equivalent
+
+  - name: sort the configs for every device at once
+    delegate_to: localhost
+    run_once: true
+    config_sort:
+      src: configs
+      glob: "*.conf"
+      dest: sorted
+      workers: 16
+
+  - name: keep the sorted sections of every device in one shared store
+    delegate_to: localhost
+    config_sort:
+      src="configs/{{ inventory_hostname }}.conf"
+      dest="sorted/{{ inventory_hostname }}.conf"
+      store=store
+      store_name="{{ inventory_hostname }}"
+
 """
 
+import glob
+import binascii
+import bz2
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import multiprocessing
 import os
+import pickle
+import re
+import stat
+import tempfile
+import time
+from contextlib import closing
+from operator import attrgetter
+
+try:
+    import lzma
+except ImportError:
+    ## Python 2 has no lzma; .xz files are not supported there.
+    lzma = None
 
 ## NO requirements
 REQ_AVAILABLE = True
@@ -89,28 +336,155 @@ REQ_AVAILABLE = True
 # except ImportError:
 #    REQ_AVAILABLE = False
 
+## Size of the reads used when hashing an existing dest.
+CHUNK_SIZE = 1024 * 1024
+
+## Buffer size used when writing dest.
+WRITE_BUFFER = 1024 * 1024
+## os.replace overwrites the target on every platform; os.rename only on POSIX.
+_replace = getattr(os, 'replace', os.rename)
+## Compressed file extensions, and the file class that handles each one.
+COMPRESSION = {
+    '.gz': gzip.GzipFile,
+    '.bz2': bz2.BZ2File,
+    '.xz': lzma.LZMAFile if lzma is not None else None,
+}
+## Suffix of the sidecar cache file written next to dest.
+CACHE_SUFFIX = '.sortcache'
+## Suffix of the state file kept next to dest for incremental sorts.
+STATE_SUFFIX = '.sortstate'
+## Configs with fewer lines than this are not worth sorting in parallel.
+PARALLEL_THRESHOLD = 100000
+## Number of spilled runs merged at a time by the external sort.
+MAX_RUNS = 64
+## Number of distinct lines kept for interning, and for sort keys. Lines
+## that repeat (e.g. '  no shutdown' under every interface) show up early,
+## and a config without repeats only pays for this many dict entries.
+INTERN_LIMIT = 4096
+## Number of differences reported by compare mode.
+COMPARE_LIMIT = 10
+## Format of the store manifests. Unlike the caches, manifests are not
+## rebuilt from src, so this only changes with their layout.
+MANIFEST_VERSION = 1
+
+
+def _source_version():
+    """Hashes this module's source, to version the caches it writes.
+
+    Any change to the module, including one that changes the sorted
+    output, gives a new version, so caches written by another version are
+    ignored without anyone having to remember to bump a number.
+
+    Returns:
+        str: Hex digest of the source, or None if it can't be read.
+    """
+    path = globals().get('__file__')
+    if path and path.endswith(('.pyc', '.pyo')) and os.path.isfile(path[:-1]):
+        path = path[:-1]
+    try:
+        with open(path, 'rb') as _:
+            return hashlib.sha1(_.read()).hexdigest()
+    except (IOError, OSError, TypeError):
+        pass
+    ## Run by Ansible, the module is imported from a zip file, as
+    ## __main__, so get_source(__name__) can't find it. Read it through
+    ## the zip loader by its path, or else by the name it was imported as.
+    loader = globals().get('__loader__')
+    spec = globals().get('__spec__')
+    try:
+        source = loader.get_data(path)
+    except Exception:
+        try:
+            source = loader.get_source(spec.name if spec is not None else __name__)
+        except Exception:
+            return None
+    if source is None:
+        return None
+    if not isinstance(source, bytes):
+        source = source.encode('utf-8')
+    return hashlib.sha1(source).hexdigest()
+
+## Version of the sidecar caches and incremental state. If the source
+## can't be read, no cache is ever fresh, rather than possibly stale.
+CACHE_VERSION = _source_version()
+
+_sortkey = attrgetter('key')
+_digits = re.compile(r'(\d+)')
+
+def natural_key(text):
+    """Sort key that orders runs of digits by their numeric value.
+
+    e.g. ``interface eth 2`` sorts before ``interface eth 10``.
+
+    Args:
+        text (str): A config line.
+
+    Returns:
+        tuple: Minus the indent, the text split into alternating str and int
+            parts, plus the text itself to break ties such as ``01`` vs ``1``.
+
+            | The indent comes first so that, as in lexical order, a more
+              indented line sorts before a less indented one. Otherwise
+              ``'  10'`` would sort before ``'   b'``, and would wrongly
+              become its parent when the sorted config is parsed again.
+    """
+    parts = _digits.split(text)
+    for i in range(1, len(parts), 2):
+        parts[i] = int(parts[i])
+    return (len(text.lstrip()) - len(text), tuple(parts), text)
+
+## Available sort orders, and the key function each one uses.
+## None means the text itself is the key.
+SORT_ORDERS = {
+    'lexical': None,
+    'natural': natural_key,
+}
+
 class Lineobj(object):
     """A class to hold meta and relative position data about each line in the config.
 
     Args:
         line (str): The config line to be stored.
-        **kwargs: Aribtrary kwargs. This is not currently used.
+        **kwargs: Aribtrary kwargs.
+
+            | key (callable): Function computing the sort key from the line.
+              Defaults to the line itself.
 
     Attributes:
         text (str): The text of the configuration line.
+        key: The sort key of the line, computed once when the Lineobj is created.
         parent (Lineobj): Parent Lineobj. This Lineobj is a ``sub`` of the parent.
         subs (list): List of Lineobjs for which this is the parent line.
+
+            | Leaf lines share an empty tuple here; the list is only
+              created when the first sub is added.
         indent (int): Number of spaces this line is indented.
 
             | This attribute is used to keep track of the hierarchy level.
             | If indent == 0, then there should be no parent.
             | if indent > 0, then this Lineobj should be a sub of another.
+        digest (bytes): sha1 of this line's subtree, set by :func:`hash_tree`.
+            None until then.
+
+    Note:
+        ``subs`` is shadowed by a private dict keyed by each sub's text so
+        that duplicate lookups in :meth:`add_sub` don't have to scan the list.
+        Always use :meth:`add_sub` to add subs so the two stay in sync.
+
+        Lineobj uses ``__slots__`` since there is one per config line and
+        a per-instance ``__dict__`` dominates memory on large configs.
     """
 
+    __slots__ = ('text', 'key', 'parent', 'subs', 'indent', 'digest', '_subindex')
+
     def __init__(self, line, **kwargs):
         self.text = line
+        key = kwargs.get('key')
+        self.key = line if key is None else key(line)
         self.parent = None
-        self.subs = []
+        self.subs = ()
+        self._subindex = None
+        self.digest = None
         self.indent = len(line) - len(line.lstrip(' '))
         super(Lineobj, self).__init__()
 
@@ -123,13 +497,17 @@ class Lineobj(object):
           lineobj (Lineobj): An object of this same type to be added as a sub
             line to self.
         """
-        for sub in self.subs:
-            if sub.text == lineobj.text: return sub
+        if self._subindex is None:
+            self._subindex = {}
+            self.subs = []
+        sub = self._subindex.get(lineobj.text)
+        if sub is not None: return sub
+        self._subindex[lineobj.text] = lineobj
         self.subs.append(lineobj)
         return lineobj
 
 
-def sort_config(config):
+def sort_config(config, order='lexical'):
     """This is the top-level function of the module.
 
     This function can be used outside of Ansible.
@@ -138,26 +516,385 @@ def sort_config(config):
         config (list): A list of configuration lines.
 
             | This is usually the result of fh.readlines().
+        order (Optional[str]): One of SORT_ORDERS. Defaults to 'lexical'.
 
     Returns:
         list: A list of configuration lines, properly sorted.
 
             | This can be used directly by fh.writelines().
     """
+    return list(iter_config(parse_config(config, order)))
+
+def parse_config(config, order='lexical'):
+    """Builds the Lineobj hierarchy for a config without sorting it.
+
+    Args:
+        config (iterable): Configuration lines.
+
+            | Any iterable of lines will do, including an open file handle,
+              so the source never has to be read into memory in one piece.
+        order (Optional[str]): One of SORT_ORDERS. The sort key for that
+            order is computed here, once per distinct line.
+
+    Returns:
+        list: The top-level Lineobjs, each with subs[] set to represent
+            the config hierarchy. Duplicate top-level lines are merged.
+    """
+    ## Identical lines (e.g. '  no shutdown' under every interface) are
+    ## interned so all their Lineobjs share one string and one sort key.
+    ## indent needs no interning; small ints are shared by Python already.
+    ## Only the first INTERN_LIMIT distinct lines are pooled.
+    pool = {}
+    key = SORT_ORDERS[order]
+    if key is not None:
+        key = _memoize(key)
     lines = {}
     currlevel = []
     for line in config:
         if line.strip() == '':
             continue
-        lineobj = lines.get(line, Lineobj(line))
         if line.startswith(' '):
-            insert_sub(currlevel, lineobj)
+            ## Top-level lines are already deduped by lines{}, so only
+            ## sub lines go through the pool.
+            interned = pool.get(line)
+            if interned is not None:
+                line = interned
+            elif len(pool) < INTERN_LIMIT:
+                pool[line] = line
+            insert_sub(currlevel, Lineobj(line, key=key))
             continue
         else:
+            lineobj = lines.get(line)
+            if lineobj is None:
+                lineobj = lines[line] = Lineobj(line, key=key)
             currlevel = [lineobj]
-            lines[line] = lineobj
             continue
-    return get_config(lines.values())
+    return list(lines.values())
+
+def _memoize(func, limit=INTERN_LIMIT):
+    """Caches the results of a one-argument function for its lifetime.
+
+    Once limit results are cached, new arguments are computed but not cached.
+    """
+    cache = {}
+    def memoized(arg):
+        result = cache.get(arg)
+        if result is None:
+            result = func(arg)
+            if len(cache) < limit:
+                cache[arg] = result
+        return result
+    return memoized
+
+def split_sections(config):
+    """Groups config lines by the top-level line they belong to.
+
+    Duplicate top-level lines are merged into one group, the same way
+    :func:`parse_config` merges them. Blank lines and indented lines that
+    come before the first top-level line are dropped, as they are when
+    sorting.
+
+    Args:
+        config (iterable): Configuration lines.
+
+    Returns:
+        dict: Top-level line -> list of the raw lines of that section,
+            including the top-level line itself, in input order.
+    """
+    sections = {}
+    section = None
+    for line in config:
+        if line.strip() == '':
+            continue
+        if not line.startswith(' '):
+            section = sections.setdefault(line, [])
+        if section is not None:
+            section.append(line)
+    return sections
+
+
+def sort_config_incremental(config, state=None, order='lexical'):
+    """Sorts a config, reusing the sorted sections of a previous run.
+
+    Each top-level section is hashed. Sections whose hash matches the one
+    recorded in ``state`` are spliced in from the previous result, and
+    only new or changed sections are parsed and sorted. The output is
+    identical to :func:`sort_config`.
+
+    Args:
+        config (iterable): Configuration lines.
+        state (Optional[dict]): The state returned by a previous call
+            with the same order.
+        order (Optional[str]): One of SORT_ORDERS.
+
+    Returns:
+        tuple: (list of sorted config lines, new state dict)
+    """
+    previous = state or {}
+    state = {}
+    for top, section in split_sections(config).items():
+        digest = digest_lines(section)
+        old = previous.get(top)
+        if old is not None and old[0] == digest:
+            state[top] = old
+        else:
+            state[top] = [digest, sort_config(section, order)]
+    sorted_config = []
+    for top in sorted(state, key=SORT_ORDERS[order]):
+        sorted_config.extend(state[top][1])
+    return sorted_config, state
+
+
+def _sort_section(job):
+    """Pool worker for :func:`sort_config_parallel`.
+
+    Args:
+        job (tuple): (list of section lines, order)
+
+    Returns:
+        list: The sorted section.
+    """
+    section, order = job
+    return sort_config(section, order)
+
+
+def _fork_pool(workers):
+    """Starts a pool of forked worker processes.
+
+    Workers started any other way (spawn, forkserver) import this module
+    by name to unpickle their jobs. That fails when it was loaded by the
+    action plugin or run by Ansible as __main__, and the pool hangs.
+
+    Args:
+        workers (int): Number of processes.
+
+    Returns:
+        multiprocessing.pool.Pool: The pool, or None if processes can't be
+            forked here, in which case the caller should work serially.
+    """
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:
+        ## Python 2 always forks, where it can.
+        return multiprocessing.Pool(workers) if os.name == 'posix' else None
+    try:
+        return get_context('fork').Pool(workers)
+    except ValueError:
+        return None
+
+
+def sort_config_parallel(config, workers, order='lexical', threshold=PARALLEL_THRESHOLD):
+    """Sorts a config, spreading the top-level sections over a process pool.
+
+    Top-level sections are independent once duplicates are merged, so each
+    one is sorted on its own and the results are concatenated in order.
+    The output is identical to :func:`sort_config`.
+
+    Args:
+        config (iterable): Configuration lines.
+        workers (int): Number of processes to use.
+        order (Optional[str]): One of SORT_ORDERS.
+        threshold (Optional[int]): Configs with fewer lines than this are
+            sorted serially, since starting the pool and shipping the
+            sections to it would cost more than it saves.
+
+    Returns:
+        list: A list of configuration lines, properly sorted.
+    """
+    sections = split_sections(config)
+    tops = sorted(sections, key=SORT_ORDERS[order])
+    jobs = [(sections[top], order) for top in tops]
+    total = sum(len(section) for section, _ in jobs)
+    workers = min(workers, len(jobs))
+    pool = None
+    if workers > 1 and total >= threshold:
+        pool = _fork_pool(workers)
+    if pool is None:
+        results = map(_sort_section, jobs)
+    else:
+        try:
+            ## Several sections per task keeps the IPC overhead down when
+            ## there are many small sections.
+            chunksize = max(1, len(jobs) // (workers * 4))
+            results = pool.map(_sort_section, jobs, chunksize=chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    sorted_config = []
+    for result in results:
+        sorted_config.extend(result)
+    return sorted_config
+
+
+def _write_run(sections, tmpdir):
+    """Writes (key, sorted section) pairs to a temporary file as one sorted run.
+
+    Args:
+        sections (iterable): (key, sorted section lines) in key order.
+        tmpdir (str): Directory for the temporary file, or None.
+
+    Returns:
+        file: The run, rewound and ready for :func:`_read_run`.
+    """
+    run = tempfile.TemporaryFile(dir=tmpdir)
+    for sortkey, section in sections:
+        pickle.dump((sortkey, section), run, pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def _spill_run(sections, order, tmpdir):
+    """Sorts the sections held in memory and writes them out as a run.
+
+    Args:
+        sections (dict): Top-level line -> raw section lines.
+        order (str): One of SORT_ORDERS.
+        tmpdir (str): Directory for the temporary file, or None.
+
+    Returns:
+        file: The run.
+    """
+    key = SORT_ORDERS[order]
+    tops = sorted(sections, key=key)
+    return _write_run(((top if key is None else key(top), sort_config(sections[top], order))
+                       for top in tops), tmpdir)
+
+
+def _read_run(run, index):
+    """Yields (key, index, sorted section) from a run written by :func:`_write_run`.
+
+    The run index keeps sections with the same key from different runs
+    from being compared by their lines in the merge.
+    """
+    while True:
+        try:
+            sortkey, section = pickle.load(run)
+        except EOFError:
+            return
+        yield sortkey, index, section
+
+
+def _merge_sections(sections, order):
+    """Merges copies of the same top-level section from different runs."""
+    if len(sections) == 1:
+        return sections[0]
+    return sort_config(itertools.chain.from_iterable(sections), order)
+
+
+def _merge_runs(runs, order):
+    """k-way merges sorted runs.
+
+    Yields:
+        tuple: (key, sorted section) in key order, with the copies of a
+            section that appear in several runs merged into one.
+    """
+    merged = heapq.merge(*[_read_run(run, i) for i, run in enumerate(runs)])
+    pending_key = None
+    pending = []
+    for sortkey, index, section in merged:
+        if pending and sortkey != pending_key:
+            yield pending_key, _merge_sections(pending, order)
+            pending = []
+        pending_key = sortkey
+        pending.append(section)
+    if pending:
+        yield pending_key, _merge_sections(pending, order)
+
+
+def _add_run(levels, run, order, tmpdir):
+    """Adds a spilled run to the lowest level, compacting full levels.
+
+    levels[k] holds runs that each contain about MAX_RUNS ** k spills.
+    When a level holds MAX_RUNS runs they are merged into one run on the
+    next level, so every line is rewritten about log(spills) / log(MAX_RUNS)
+    times, and at most MAX_RUNS runs are open per level.
+
+    Args:
+        levels (list): Lists of runs, changed in place.
+        run (file): The new run.
+        order (str): One of SORT_ORDERS.
+        tmpdir (str): Directory for the temporary files, or None.
+    """
+    level = 0
+    while True:
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(run)
+        if len(levels[level]) < MAX_RUNS:
+            return
+        runs = levels[level]
+        levels[level] = []
+        run = _write_run(_merge_runs(runs, order), tmpdir)
+        for old in runs:
+            old.close()
+        level += 1
+
+
+def sort_config_external(config, max_lines, order='lexical', tmpdir=None):
+    """Sorts a config that may not fit in memory.
+
+    Top-level sections are collected until about max_lines lines are held,
+    then sorted and spilled to a temporary file as a sorted run. Once the
+    input is exhausted the runs are k-way merged. Sections with the same
+    top-level line in several runs are merged and sorted again, just as
+    :func:`sort_config` merges duplicate top-level lines. Runs are merged
+    in levels of MAX_RUNS (see :func:`_add_run`), so the number of open
+    files stays bounded and each line is only rewritten a few times.
+
+    Memory use is bounded by max_lines plus the largest single section.
+
+    Args:
+        config (iterable): Configuration lines, e.g. an open file handle.
+        max_lines (int): Number of lines to hold before spilling a run.
+        order (Optional[str]): One of SORT_ORDERS.
+        tmpdir (Optional[str]): Directory for the run files. Defaults to
+            the system temp directory.
+
+    Yields:
+        str: Config lines in sorted order, identical to :func:`sort_config`.
+    """
+    levels = []
+    try:
+        sections = {}
+        section = None
+        held = 0
+        for line in config:
+            if line.strip() == '':
+                continue
+            if not line.startswith(' '):
+                if held >= max_lines:
+                    _add_run(levels, _spill_run(sections, order, tmpdir), order, tmpdir)
+                    sections = {}
+                    held = 0
+                section = sections.setdefault(line, [])
+            if section is not None:
+                section.append(line)
+                held += 1
+        if not levels:
+            ## Everything fit in memory.
+            for top in sorted(sections, key=SORT_ORDERS[order]):
+                for line in sort_config(sections[top], order):
+                    yield line
+            return
+        if sections:
+            _add_run(levels, _spill_run(sections, order, tmpdir), order, tmpdir)
+        sections = section = None
+        ## Each level holds fewer than MAX_RUNS runs. If there are too many
+        ## in total for one merge, compact the smaller levels first.
+        runs = [run for level in levels for run in level]
+        levels[:] = [runs]
+        while len(runs) > MAX_RUNS:
+            merged = _write_run(_merge_runs(runs[:MAX_RUNS], order), tmpdir)
+            for old in runs[:MAX_RUNS]:
+                old.close()
+            runs[:MAX_RUNS] = [merged]
+        for sortkey, section in _merge_runs(runs, order):
+            for line in section:
+                yield line
+    finally:
+        for level in levels:
+            for run in level:
+                run.close()
+
 
 def insert_sub(currlevel, lineobj):
     """Figures out the correct Lineobj to insert the current line
@@ -185,8 +922,8 @@ def insert_sub(currlevel, lineobj):
 
 
 def get_config(lines):
-    """Recursive function that iterates over the hierarchical Lineobjs
-    to produce a flat list of config lines.
+    """Iterates over the hierarchical Lineobjs to produce a flat list
+    of config lines.
 
     Args:
         lines (list): A list of Lineobjs.
@@ -198,64 +935,1438 @@ def get_config(lines):
         list: A *flat* sorted list of config lines that can be used with fh.writelines()
             to write to a configuration file.
     """
-    config = []
-    for line in sorted(lines, key=lambda k: k.text):
-        config.append(line.text)
-        config.extend(get_config(line.subs))
-    return config
+    return list(iter_config(lines))
 
 
-def module_main(module):
-    """Main Ansible module function.
+def iter_config(lines):
+    """Generator version of :func:`get_config`.
 
-    This just does Ansible stuff like collect/format args and set
-    value of changed attribute.
+    The hierarchy is walked with an explicit stack of iterators, one per
+    level, so deep configs don't run into the recursion limit and no
+    intermediate lists are built. Memory use is proportional to the depth
+    of the tree (plus the width of each level being walked).
 
     Args:
-        module (ansible.module_utils.basic.AnsibleModule): The base ansible module.
+        lines (list): A list of Lineobjs.
+
+    Yields:
+        str: Config lines in sorted order.
+    """
+    stack = [iter(sorted(lines, key=_sortkey))]
+    while stack:
+        for line in stack[-1]:
+            yield line.text
+            if line.subs:
+                ## subs are sorted in place so that walking the same tree
+                ## again (e.g. to hash it and then write it) is cheap.
+                line.subs.sort(key=_sortkey)
+                stack.append(iter(line.subs))
+                break
+        else:
+            stack.pop()
+
+
+class _SortedWalk(object):
+    """Walks a sorted config, keeping track of the parents of each line.
+
+    Sort keys are only computed when :meth:`keypath` asks for them, so
+    lines that :func:`diff_config` can match on their text alone cost no
+    more than reading them.
+
+    Args:
+        config (iterable): Lines of a sorted config.
+        order (Optional[str]): The SORT_ORDERS entry config was sorted with.
+
+    Attributes:
+        line (str): The current line, or None once the config is exhausted.
+        texts (list): Texts of the current line and its parents.
     """
-    srcfile = module.params['src']
-    destfile = module.params['dest']
-    with open(srcfile) as _:
-        config = _.readlines()
-        sorted_config = sort_config(config)
-    if os.path.isfile(destfile):
-        with open(destfile) as _:
-            old_sorted_config = _.readlines()
+
+    __slots__ = ('_lines', '_key', '_indents', '_keys', '_sibling', 'line', 'texts')
+
+    def __init__(self, config, order='lexical'):
+        self._lines = iter(config)
+        self._key = SORT_ORDERS[order]
+        self._indents = []
+        ## Sort keys of texts, None until keypath() computes them.
+        self._keys = []
+        ## (text, key) of the line before the current one at its level.
+        self._sibling = None
+        self.line = None
+        self.texts = []
+
+    def _push(self, line):
+        """Makes line the current line.
+
+        Blank lines, and indented lines without a parent (which sorting
+        drops), are skipped.
+
+        Returns:
+            bool: False if the line was skipped.
+        """
+        stripped = line.lstrip(' ')
+        if not stripped.strip():
+            return False
+        indent = len(line) - len(stripped)
+        indents = self._indents
+        depth = len(indents)
+        level = depth
+        while level and indents[level - 1] >= indent:
+            level -= 1
+        if level < depth:
+            self._sibling = (self.texts[level], self._keys[level])
+            del indents[level:], self.texts[level:], self._keys[level:]
+        else:
+            self._sibling = None
+        if indent and not level:
+            return False
+        indents.append(indent)
+        self.texts.append(line)
+        self._keys.append(None)
+        self.line = line
+        return True
+
+    def advance(self):
+        """Moves on to the next line that isn't skipped.
+
+        Returns:
+            str: The new current line, or None at the end of the config.
+        """
+        for line in self._lines:
+            if self._push(line):
+                return line
+        self.line = None
+        return None
+
+    def advance_common(self, other):
+        """Advances this walk and other past the lines they have in common.
+
+        Both walks must be under the same parents. Equal lines then have
+        equal parents too, so while the lines match only this walk keeps
+        track of them, and other takes its parents over once they differ.
+
+        Args:
+            other (_SortedWalk): The walk of the other config.
+
+        Returns:
+            tuple: The new current lines of both walks, as from :meth:`advance`.
+        """
+        theirs = other._lines
+        for line in self._lines:
+            their = next(theirs, None)
+            if line != their:
+                break
+            self._push(line)
+        else:
+            line = their = None
+        other._indents[:] = self._indents
+        other._keys[:] = self._keys
+        other.texts[:] = self.texts
+        if line is None:
+            self.line = None
+        elif not self._push(line):
+            self.advance()
+        if their is None and line is not None:
+            other.line = None
+        elif their is None or not other._push(their):
+            other.advance()
+        return self.line, other.line
+
+    def keypath(self):
+        """Returns the sort keys of the current line and its parents.
+
+        Raises:
+            ValueError: If the current line sorts before the one ahead of it.
+        """
+        key = self._key
+        keys = self._keys
+        if key is None:
+            keys[:] = self.texts
+        else:
+            for i, k in enumerate(keys):
+                if k is None:
+                    keys[i] = key(self.texts[i])
+        if self._sibling is not None:
+            text, sibling = self._sibling
+            if sibling is None:
+                sibling = text if key is None else key(text)
+            if keys[-1] <= sibling:
+                raise ValueError('config is not sorted: %r' % self.line)
+            self._sibling = None
+        return tuple(keys)
+
+
+def diff_config(old, new, order='lexical'):
+    """Computes a hierarchy-aware diff between two sorted configs.
+
+    Since both configs are sorted, every line's path of parent lines orders
+    it the same way on both sides, so the diff is a single linear merge
+    walk over the two line streams; no trees are built. Sort keys are only
+    computed where the configs differ; lines they have in common are
+    matched on their text. Lines that only
+    exist on one side are reported along with their whole subtree, grouped
+    under their parent lines.
+
+    Args:
+        old (iterable): Lines of the old sorted config, e.g. an open dest file.
+        new (iterable): Lines of the new sorted config, e.g. from :func:`iter_config`.
+        order (Optional[str]): The SORT_ORDERS entry both configs were sorted with.
+
+    Returns:
+        list: One dict per parent whose subs changed, in config order::
+
+            {
+                'path': ['interface eth 1', '  ip ospf'],  # parent lines
+                'removed': ['    area 0\n'],                # old subtrees
+                'added': ['    area 1\n'],                  # new subtrees
+            }
+
+            An empty list means the configs are identical.
+
+    Raises:
+        ValueError: If either config is not sorted. Run it through
+            :func:`sort_config` first. Only the lines where the configs
+            differ are checked, which is enough to catch any unsorted
+            line in one config as long as the other is sorted.
+    """
+    changes = {}
+    ## For each kind: the keypath of the subtree currently being added or
+    ## removed, and the change entry its lines go into.
+    current = {'removed': (None, None), 'added': (None, None)}
+    def record(kind, keypath, textpath):
+        root, entry = current[kind]
+        if root is None or keypath[:len(root)] != root:
+            parent = keypath[:-1]
+            entry = changes.get(parent)
+            if entry is None:
+                entry = changes[parent] = {
+                    'path': [t.rstrip('\r\n') for t in textpath[:-1]],
+                    'removed': [],
+                    'added': [],
+                }
+            current[kind] = (keypath, entry)
+        entry[kind].append(textpath[-1])
+    olds = _SortedWalk(old, order)
+    news = _SortedWalk(new, order)
+    ## Sort keys are only needed where the configs differ. Both walks
+    ## start, and are back after equal paths, under the same parents, so
+    ## the lines they have in common can be skipped on their text alone.
+    a, b = olds.advance_common(news)
+    while a is not None and b is not None:
+        keypath_a = olds.keypath()
+        keypath_b = news.keypath()
+        if keypath_a == keypath_b:
+            a, b = olds.advance_common(news)
+        elif keypath_a < keypath_b:
+            record('removed', keypath_a, olds.texts)
+            a = olds.advance()
+        else:
+            record('added', keypath_b, news.texts)
+            b = news.advance()
+    while a is not None:
+        record('removed', olds.keypath(), olds.texts)
+        a = olds.advance()
+    while b is not None:
+        record('added', news.keypath(), news.texts)
+        b = news.advance()
+    return [changes[k] for k in sorted(changes)]
+
+
+def render_diff(changes, before_header='before', after_header='after'):
+    """Renders the output of :func:`diff_config` in a unified-diff style.
+
+    Each changed level gets a ``@@`` header naming its parents, followed
+    by the parent lines as context and the removed and added lines.
+
+    Args:
+        changes (list): Output of :func:`diff_config`.
+        before_header (Optional[str]): Label for the old config.
+        after_header (Optional[str]): Label for the new config.
+
+    Returns:
+        str: The rendered diff, or ``''`` if there are no changes.
+    """
+    if not changes:
+        return ''
+    out = ['--- %s\n' % before_header, '+++ %s\n' % after_header]
+    for change in changes:
+        out.append('@@ %s @@\n' % (' > '.join(p.strip() for p in change['path']) or 'top level'))
+        for line in change['path']:
+            out.append(' %s\n' % line)
+        for prefix, lines in (('-', change['removed']), ('+', change['added'])):
+            for line in lines:
+                out.append('%s%s\n' % (prefix, line.rstrip('\r\n')))
+    return ''.join(out)
+
+
+def hash_tree(lines):
+    """Computes a Merkle hash of every Lineobj subtree, bottom-up.
+
+    A line's digest is the sha1 of its text followed by the digests of its
+    subs, in digest order. Two subtrees therefore hash the same exactly when
+    they sort to the same text, whatever order their lines came in and
+    whichever sort order is used. Line endings are not part of the hash.
+
+    The tree is walked with an explicit stack of iterators, as in
+    :func:`iter_config`.
+
+    Args:
+        lines (list): Top-level Lineobjs, as returned by :func:`parse_config`.
+
+    Returns:
+        list: lines, with ``digest`` set on every Lineobj.
+    """
+    sha1 = hashlib.sha1
+    stack = [iter(lines)]
+    parents = [None]
+    while stack:
+        for line in stack[-1]:
+            if line.subs:
+                stack.append(iter(line.subs))
+                parents.append(line)
+                break
+            line.digest = sha1(_to_bytes(line.text.rstrip('\r\n') + '\n')).digest()
+        else:
+            ## All subs of the parent are hashed now, so it can be too.
+            stack.pop()
+            line = parents.pop()
+            if line is not None:
+                digest = sha1(_to_bytes(line.text.rstrip('\r\n') + '\n'))
+                digest.update(b''.join(sorted(sub.digest for sub in line.subs)))
+                line.digest = digest.digest()
+    return lines
+
+
+def section_hashes(lines):
+    """Returns the Merkle hash of each top-level section.
+
+    Args:
+        lines (list): Top-level Lineobjs, hashed by :func:`hash_tree`.
+
+    Returns:
+        dict: Top-level line (without line ending) -> hex digest.
+    """
+    return dict((line.text.rstrip('\r\n'), binascii.hexlify(line.digest).decode('ascii'))
+                for line in lines)
+
+
+def _by_text(lines):
+    """Indexes Lineobjs by their text without line ending."""
+    return dict((line.text.rstrip('\r\n'), line) for line in lines)
+
+
+def _level_difference(path, olds, news):
+    """Compares one level of two hashed trees.
+
+    Returns:
+        tuple: (change, changed) where change is a diff_config style entry
+            for the lines only on one side (or None if there are none), and
+            changed the (old, new) pairs of common lines whose hashes differ,
+            in sort order.
+    """
+    olds = _by_text(olds)
+    news = _by_text(news)
+    removed = sorted((line for text, line in olds.items() if text not in news), key=_sortkey)
+    added = sorted((line for text, line in news.items() if text not in olds), key=_sortkey)
+    change = None
+    if removed or added:
+        change = {
+            'path': path,
+            'removed': [line.text for line in removed],
+            'added': [line.text for line in added],
+        }
+    changed = sorted((line for text, line in olds.items()
+                      if text in news and line.digest != news[text].digest), key=_sortkey)
+    return change, [(line, news[line.text.rstrip('\r\n')]) for line in changed]
+
+
+def compare_config(old, new, order='lexical', limit=None):
+    """Checks whether two configs are equivalent once sorted, without sorting them.
+
+    Both configs are parsed and hashed with :func:`hash_tree`. Sections
+    with equal hashes are skipped whole. For a section that differs, the
+    hashes are followed down to the first level where lines were added or
+    removed, so only that part is reported.
+
+    Args:
+        old (iterable): Lines of the old config, in any order.
+        new (iterable): Lines of the new config, in any order.
+        order (Optional[str]): One of SORT_ORDERS. Only used to order the
+            differences.
+        limit (Optional[int]): Stop once this many differences are found.
+
+    Returns:
+        tuple: (differences, old_hashes, new_hashes).
+
+            | differences is a list of entries shaped like those of
+              :func:`diff_config`, except that ``removed`` and ``added`` only
+              hold the differing lines themselves, not their subtrees. The
+              first entry covers whole top-level sections that are only on one
+              side; then there is one entry per changed section, in config
+              order. Lines are reported without their line endings. An empty
+              list means the configs are equivalent.
+            | old_hashes and new_hashes are the :func:`section_hashes` of
+              each config.
+    """
+    ## Line endings are stripped before parsing, so that lines which only
+    ## differ by them are merged like any other duplicates. Otherwise a
+    ## parent could hold both, and they would hash the same but not line up.
+    olds = hash_tree(parse_config((line.rstrip('\r\n') for line in old), order))
+    news = hash_tree(parse_config((line.rstrip('\r\n') for line in new), order))
+    differences = []
+    change, changed = _level_difference([], olds, news)
+    if change is not None:
+        differences.append(change)
+    for a, b in changed:
+        if limit and len(differences) >= limit:
+            break
+        path = [a.text.rstrip('\r\n')]
+        change, below = _level_difference(path, a.subs, b.subs)
+        while change is None:
+            ## Equal text but different hashes means the difference is
+            ## further down; follow the first sub that differs.
+            a, b = below[0]
+            path = path + [a.text.rstrip('\r\n')]
+            change, below = _level_difference(path, a.subs, b.subs)
+        differences.append(change)
+    return differences, section_hashes(olds), section_hashes(news)
+
+
+def config_stats(config):
+    """Measures the shape of a sorted config in one pass.
+
+    Args:
+        config (iterable): Lines of a sorted config.
+
+    Returns:
+        dict: ``lines``, the number of top-level ``sections``, ``max_depth``
+            (1 for a config with no indented lines), and ``widest``, the line
+            with the most direct subs and how many it has.
+    """
+    stats = {'lines': 0, 'sections': 0, 'max_depth': 0,
+             'widest': {'line': None, 'subs': 0}}
+    ## [indent, text, number of subs] for the current line and its parents
+    stack = []
+    def close(entry):
+        if entry[2] > stats['widest']['subs']:
+            stats['widest'] = {'line': entry[1].rstrip('\r\n'), 'subs': entry[2]}
+    for line in config:
+        if line.strip() == '':
+            continue
+        indent = len(line) - len(line.lstrip(' '))
+        while stack and stack[-1][0] >= indent:
+            close(stack.pop())
+        if stack:
+            stack[-1][2] += 1
+        else:
+            stats['sections'] += 1
+        stack.append([indent, line, 0])
+        stats['lines'] += 1
+        stats['max_depth'] = max(stats['max_depth'], len(stack))
+    while stack:
+        close(stack.pop())
+    return stats
+
+
+class _Timer(object):
+    """Collects the wall time of named stages.
+
+    Use as ``with timer('parse'): ...``. A disabled timer does nothing.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.timings = {}
+        self._stage = None
+
+    def __call__(self, stage):
+        self._stage = stage
+        return self
+
+    def __enter__(self):
+        if self.enabled:
+            self._start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            elapsed = time.time() - self._start
+            self.timings[self._stage] = round(self.timings.get(self._stage, 0) + elapsed, 6)
+        return False
+
+
+def _to_bytes(text):
+    """Encodes text for hashing. Byte strings are passed through."""
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+
+def digest_lines(lines):
+    """Computes a sha1 digest over an iterable of lines without joining them.
+
+    Args:
+        lines (iterable): Lines of text, e.g. the output of :func:`iter_config`.
+
+    Returns:
+        str: Hex digest.
+    """
+    digest = hashlib.sha1()
+    for line in lines:
+        digest.update(_to_bytes(line))
+    return digest.hexdigest()
+
+
+def digest_file(path):
+    """Computes the same digest as :func:`digest_lines` for a file, read in chunks.
+
+    Args:
+        path (str): File to hash. Compressed files are hashed by their
+            uncompressed contents.
+
+    Returns:
+        str: Hex digest. A missing file hashes the same as an empty one.
+    """
+    digest = hashlib.sha1()
+    if not os.path.isfile(path):
+        return digest.hexdigest()
+    with _open_config(path) as _:
+        for chunk in iter(lambda: _.read(CHUNK_SIZE), ''):
+            digest.update(_to_bytes(chunk))
+    return digest.hexdigest()
+
+
+def _read_file(path):
+    """Returns the contents of path, or ``''`` if it does not exist."""
+    if not os.path.isfile(path):
+        return ''
+    with _open_config(path) as _:
+        return _.read()
+
+
+class _BZ2Writer(object):
+    """Compresses text into a binary file object as bz2.
+
+    Python 2's BZ2File only takes a file name, not a file object, so dest
+    files are compressed with a BZ2Compressor instead.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.compressor = bz2.BZ2Compressor()
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.compress(_to_bytes(data)))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def close(self):
+        if self.compressor is not None:
+            self.fileobj.write(self.compressor.flush())
+            self.compressor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def _compressed(target, ext, mode='r'):
+    """Opens a compressed file as text.
+
+    gzip files are written with no name or timestamp in their header, so
+    the same config always compresses to the same bytes.
+
+    Args:
+        target: A path to read, or a binary file object to write to.
+        ext (str): One of the COMPRESSION extensions.
+        mode (Optional[str]): ``r`` or ``w``.
+
+    Returns:
+        file: A text file object.
+    """
+    cls = COMPRESSION[ext]
+    if cls is None:
+        raise IOError('the lzma module is needed for %s files' % ext)
+    if cls is gzip.GzipFile and mode == 'w':
+        fh = cls(filename='', mode='wb', fileobj=target, mtime=0)
+    elif cls is bz2.BZ2File and mode == 'w' and str is bytes:
+        return _BZ2Writer(target)
     else:
-        old_sorted_config = []
-    result = {}
-    diff = {
+        fh = cls(target, mode + 'b')
+    if str is bytes:
+        ## Python 2: the binary file already reads and writes str.
+        return fh
+    return io.TextIOWrapper(fh)
+
+
+def _open_config(path):
+    """Opens a config file for reading, decompressing it if its name ends
+    in one of the COMPRESSION extensions.
+
+    Args:
+        path (str): File to open.
+
+    Returns:
+        file: A text file object.
+    """
+    ext = os.path.splitext(path)[1]
+    if ext not in COMPRESSION:
+        return open(path)
+    return _compressed(path, ext)
+
+
+def _fragments(srcdir, regexp=None, ignore_hidden=False):
+    """Lists the fragment files in srcdir the way the assemble module picks them.
+
+    Args:
+        srcdir (str): Directory of fragments.
+        regexp (Optional[str]): Only use files whose names match this.
+        ignore_hidden (Optional[bool]): Skip files whose names start with ``.``.
+
+    Returns:
+        list: Paths of the fragments, in file name order.
+    """
+    pattern = re.compile(regexp) if regexp else None
+    paths = []
+    for name in sorted(os.listdir(srcdir)):
+        if pattern is not None and not pattern.search(name):
+            continue
+        if ignore_hidden and name.startswith('.'):
+            continue
+        path = os.path.join(srcdir, name)
+        if os.path.isfile(path):
+            paths.append(path)
+    return paths
+
+
+def _read_fragments(srcdir, regexp=None, ignore_hidden=False):
+    """Yields the lines assemble would write for srcdir, without writing them.
+
+    As in assemble, a newline is added between two fragments if the
+    first one doesn't end with one. Fragments are read one at a time.
+
+    Args:
+        srcdir (str): Directory of fragments.
+        regexp (Optional[str]): Only use files whose names match this.
+        ignore_hidden (Optional[bool]): Skip files whose names start with ``.``.
+
+    Yields:
+        str: Config lines.
+    """
+    last = None
+    for path in _fragments(srcdir, regexp, ignore_hidden):
+        if last is not None:
+            yield last if last.endswith('\n') else last + '\n'
+            last = None
+        with _open_config(path) as _:
+            for line in _:
+                if last is not None:
+                    yield last
+                last = line
+    if last is not None:
+        yield last
+
+
+def _open_src(params):
+    """Opens src for reading, or reads its fragments if it is a directory.
+
+    Returns:
+        An iterable of lines that can be closed when done.
+    """
+    if os.path.isdir(params['src']):
+        return _read_fragments(params['src'], params.get('regexp'), params.get('ignore_hidden'))
+    return _open_config(params['src'])
+
+
+def _hash_lines(lines, digest, counter=None):
+    """Passes lines through unchanged while feeding them to digest.
+
+    If a counter list is given, its first item is set to the number of
+    lines once they have all been consumed.
+    """
+    n = 0
+    for n, line in enumerate(lines, 1):
+        digest.update(_to_bytes(line))
+        yield line
+    if counter is not None:
+        counter[0] = n
+
+
+def _file_state(path):
+    """Returns the (size, mtime) of path, or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+
+def load_cache(cachefile, version=None):
+    """Reads a sidecar cache file written by :func:`save_cache`.
+
+    Args:
+        cachefile (str): Path of the cache file.
+        version (Optional): The version it must have been written with.
+            Defaults to CACHE_VERSION.
+
+    Returns:
+        dict: The cache entry, or None if it is missing, unreadable or
+            was written by a different version.
+    """
+    if version is None:
+        version = CACHE_VERSION
+    if version is None:
+        return None
+    try:
+        with open(cachefile) as _:
+            cache = json.load(_)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(cache, dict) or cache.get('version') != version:
+        return None
+    return cache
+
+
+def save_cache(cachefile, srcfile, src_digest, destfile, out_digest, options=None):
+    """Writes a sidecar cache entry for a completed sort.
+
+    Failing to write the cache is not an error; the next run just won't
+    be able to skip the sort.
+
+    Args:
+        cachefile (str): Path of the cache file.
+        srcfile (str): The sorted source file.
+        src_digest (str): sha1 of the source contents.
+        destfile (str): The file the sorted output lives in.
+        out_digest (str): sha1 of the sorted output.
+        options (Optional[dict]): Params that affect the sorted output.
+    """
+    cache = {
+        'version': CACHE_VERSION,
+        'options': options or {},
+        'src': _file_state(srcfile),
+        'src_sha1': src_digest,
+        'dest': _file_state(destfile),
+        'dest_sha1': out_digest,
+    }
+    try:
+        with open(cachefile, 'w') as _:
+            json.dump(cache, _)
+    except (IOError, OSError):
+        pass
+
+
+def cache_is_fresh(cache, srcfile, destfile, options=None):
+    """Decides if a cache entry still describes srcfile and destfile.
+
+    dest must have the exact size and mtime that were recorded. src may
+    have been touched as long as its contents still hash the same.
+
+    Args:
+        cache (dict): Entry returned by :func:`load_cache`.
+        srcfile (str): The source file, or directory of fragments.
+        destfile (str): The dest file.
+        options (Optional[dict]): Params that affect the sorted output. They
+            must be the same as when the cache was saved.
+
+    Returns:
+        bool: True if sorting srcfile again would not change destfile.
+    """
+    if cache is None or cache.get('options') != (options or {}):
+        return False
+    if _file_state(destfile) != cache['dest']:
+        return False
+    if os.path.isdir(srcfile):
+        ## Editing a fragment changes neither the size nor the mtime of
+        ## the directory, so the fragments always have to be hashed.
+        options = options or {}
+        return digest_lines(_read_fragments(
+            srcfile, options.get('regexp'), options.get('ignore_hidden'))) == cache['src_sha1']
+    src_state = _file_state(srcfile)
+    if src_state is None or src_state[0] != cache['src'][0]:
+        return False
+    if src_state == cache['src']:
+        return True
+    return digest_file(srcfile) == cache['src_sha1']
+
+
+def load_state(statefile, options=None):
+    """Reads the sections saved by :func:`save_state` for incremental sorts.
+
+    Args:
+        statefile (str): Path of the state file.
+        options (Optional[dict]): Params that affect the sorted output. The
+            state is ignored if it was saved with different options.
+
+    Returns:
+        dict: State for :func:`sort_config_incremental`, or None if the file
+            is missing, unreadable or was written by a different CACHE_VERSION.
+    """
+    state = load_cache(statefile)
+    if state is None or state.get('options') != (options or {}):
+        return None
+    return state.get('sections')
+
+
+def _state_changed(previous, state):
+    """Tells whether an incremental sort changed any section.
+
+    Args:
+        previous (dict): The state loaded by :func:`load_state`, or None.
+        state (dict): The state returned by :func:`sort_config_incremental`.
+
+    Returns:
+        bool: False if both hold the same sections with the same digests,
+            so the state file needn't be written again.
+    """
+    if previous is None or len(previous) != len(state):
+        return True
+    for top, section in state.items():
+        old = previous.get(top)
+        if old is None or old[0] != section[0]:
+            return True
+    return False
+
+
+def save_state(statefile, state, options=None):
+    """Saves the state returned by :func:`sort_config_incremental`.
+
+    Args:
+        statefile (str): Path of the state file.
+        state (dict): Sorted sections keyed by top-level line.
+        options (Optional[dict]): Params that affect the sorted output.
+    """
+    try:
+        with open(statefile, 'w') as _:
+            json.dump({'version': CACHE_VERSION, 'options': options or {},
+                       'sections': state}, _)
+    except (IOError, OSError):
+        pass
+
+
+def _sorted_sections(config, order='lexical'):
+    """Parses a sorted config one top-level section at a time.
+
+    Only one section is held in memory at once, so this works on the
+    output of any of the sort functions, including the external sort.
+
+    Args:
+        config (iterable): Lines of a sorted config.
+        order (Optional[str]): The SORT_ORDERS entry config was sorted with.
+
+    Yields:
+        Lineobj: Each top-level line, with its subs.
+    """
+    section = []
+    for line in config:
+        if section and not line.startswith(' ') and line.strip() != '':
+            for top in parse_config(section, order):
+                yield top
+            section = []
+        section.append(line)
+    for top in parse_config(section, order):
+        yield top
+
+
+def _object_path(storedir, order, digest):
+    """Returns the path of a section object in the store."""
+    return os.path.join(storedir, 'objects', order, digest[:2], digest[2:])
+
+
+def _manifest_path(storedir, name):
+    """Returns the path of a host manifest in the store.
+
+    Raises:
+        ValueError: If name would put the manifest outside the store.
+    """
+    manifests = os.path.normpath(os.path.join(storedir, 'manifests'))
+    path = os.path.normpath(os.path.join(manifests, name + '.json'))
+    if os.path.isabs(name) or not path.startswith(manifests + os.sep):
+        raise ValueError('store_name %r is outside the store' % name)
+    return path
+
+
+def _makedirs(path):
+    """Creates path and its parents, if another process hasn't already."""
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def load_manifest(storedir, name):
+    """Reads a host manifest written by :func:`store_config`.
+
+    Args:
+        storedir (str): The store directory.
+        name (str): The host's manifest name.
+
+    Returns:
+        dict: The manifest, with the ``order`` the config was sorted with and
+            its ``sections`` as [top-level line, hex digest] pairs in config
+            order, or None if it is missing, unreadable or was written by a
+            different MANIFEST_VERSION.
+    """
+    return load_cache(_manifest_path(storedir, name), MANIFEST_VERSION)
+
+
+def store_config(storedir, name, sections, order='lexical'):
+    """Saves a sorted config in a content-addressed store.
+
+    Every top-level section is written once, to a file named after its
+    :func:`hash_tree` digest, and the host gets a manifest listing its
+    sections. Hosts that share sections share their files, so a store for
+    a fleet grows with the number of unique sections rather than hosts
+    times sections. Sections already in the store are not rendered again.
+
+    Since the hash ignores line endings, a section is stored with the line
+    endings of the first config it was seen in.
+
+    Args:
+        storedir (str): The store directory. It is created if needed.
+        name (str): The host's manifest name.
+        sections (iterable): Top-level Lineobjs, in config order. They are
+            hashed here if they haven't been already.
+        order (Optional[str]): The SORT_ORDERS entry used to sort them. Each
+            order has its own objects, since it changes the section text.
+
+    Returns:
+        dict: The ``manifest`` path, the number of ``sections`` and the number
+            of them that were ``new`` to the store.
+    """
+    entries = []
+    new = 0
+    for section in sections:
+        if section.digest is None:
+            hash_tree([section])
+        digest = binascii.hexlify(section.digest).decode('ascii')
+        entries.append([section.text.rstrip('\r\n'), digest])
+        path = _object_path(storedir, order, digest)
+        if not os.path.isfile(path):
+            _makedirs(os.path.dirname(path))
+            ## Written via a rename, so hosts sharing the section can
+            ## store it at the same time.
+            write_atomic(path, iter_config([section]))
+            new += 1
+    manifest = {'version': MANIFEST_VERSION, 'order': order, 'sections': entries}
+    path = _manifest_path(storedir, name)
+    if load_cache(path, MANIFEST_VERSION) != manifest:
+        _makedirs(os.path.dirname(path))
+        write_atomic(path, [json.dumps(manifest)])
+    return {'manifest': path, 'sections': len(entries), 'new': new}
+
+
+def restore_config(storedir, name):
+    """Rebuilds a host's sorted config from the store.
+
+    Args:
+        storedir (str): The store directory.
+        name (str): The host's manifest name.
+
+    Yields:
+        str: The lines of the sorted config, as :func:`store_config` got them.
+
+    Raises:
+        IOError: If the host has no manifest, or one of its sections is missing.
+    """
+    manifest = load_manifest(storedir, name)
+    if manifest is None:
+        raise IOError('no manifest for %s in %s' % (name, storedir))
+    for _, digest in manifest['sections']:
+        with open(_object_path(storedir, manifest['order'], digest)) as _:
+            for line in _:
+                yield line
+
+
+def diff_stored(storedir, old, new):
+    """Diffs the stored configs of two hosts, like :func:`diff_config`.
+
+    Sections with the same digest in both manifests are skipped without
+    being read, so only the sections that differ are diffed.
+
+    Args:
+        storedir (str): The store directory.
+        old (str): Manifest name of the old config.
+        new (str): Manifest name of the new config.
+
+    Returns:
+        list: The changes returned by diff_config.
+
+    Raises:
+        IOError: If a manifest or section is missing.
+        ValueError: If the configs were sorted with different orders.
+    """
+    manifests = [load_manifest(storedir, name) for name in (old, new)]
+    for name, manifest in zip((old, new), manifests):
+        if manifest is None:
+            raise IOError('no manifest for %s in %s' % (name, storedir))
+    order = manifests[0]['order']
+    if manifests[1]['order'] != order:
+        raise ValueError('%s and %s were sorted in different orders' % (old, new))
+    common = set(map(tuple, manifests[0]['sections'])) & set(map(tuple, manifests[1]['sections']))
+    def changed(manifest):
+        for entry in manifest['sections']:
+            if tuple(entry) in common:
+                continue
+            with open(_object_path(storedir, order, entry[1])) as _:
+                for line in _:
+                    yield line
+    return diff_config(changed(manifests[0]), changed(manifests[1]), order)
+
+
+def _diff_dest(destfile, output, order='lexical'):
+    """Runs :func:`diff_config` between dest and the sorted output.
+
+    dest is normally a file written by this module and already sorted. If
+    it isn't, it is sorted first so the diff still lines up.
+
+    Args:
+        destfile (str): The dest file. A missing file diffs as empty.
+        output (callable): Returns a fresh iterator over the sorted output.
+        order (Optional[str]): The SORT_ORDERS entry the output was sorted with.
+
+    Returns:
+        list: The changes returned by diff_config.
+    """
+    if not os.path.isfile(destfile):
+        return diff_config([], output(), order)
+    try:
+        with _open_config(destfile) as _:
+            return diff_config(_, output(), order)
+    except ValueError:
+        with _open_config(destfile) as _:
+            return diff_config(sort_config(_, order), output(), order)
+
+
+def write_atomic(path, lines, fsync=False, preserve=True):
+    """Writes lines to path so that readers never see a partial file.
+
+    The lines are written with large buffered writes to a temporary file in
+    the same directory, which is then renamed over path. If path is a
+    symlink, the file it points to is replaced.
+
+    Args:
+        path (str): File to write. It is compressed if its name ends in one
+            of the COMPRESSION extensions.
+        lines (iterable): Lines to write.
+        fsync (Optional[bool]): fsync the file and its directory, so the
+            new contents survive a crash as soon as this returns.
+        preserve (Optional[bool]): Give the new file the mode and owner of
+            the one it replaces, as rewriting it in place would have. If
+            False, or path does not exist yet, the file gets the default
+            mode for the current umask.
+    """
+    path = os.path.realpath(path)
+    dirname, basename = os.path.split(path)
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.%s.' % basename, suffix='.tmp')
+    ext = os.path.splitext(path)[1]
+    try:
+        with os.fdopen(fd, 'wb' if ext in COMPRESSION else 'w', WRITE_BUFFER) as _:
+            if ext in COMPRESSION:
+                with _compressed(_, ext, 'w') as out:
+                    out.writelines(lines)
+            else:
+                _.writelines(lines)
+            _.flush()
+            if fsync:
+                os.fsync(_.fileno())
+        try:
+            st = os.stat(path) if preserve else None
+        except OSError:
+            st = None
+        if st is not None:
+            os.chmod(tmppath, stat.S_IMODE(st.st_mode))
+            try:
+                os.chown(tmppath, st.st_uid, st.st_gid)
+            except OSError:
+                ## Only root can give files away; keep what we have.
+                pass
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmppath, 0o666 & ~umask)
+        _replace(tmppath, path)
+    except Exception:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+        raise
+    if fsync:
+        dirfd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+
+def _make_diff(destfile, sorted_config):
+    """Builds the before/after diff dict that Ansible displays."""
+    return {
         'before_header': destfile,
-        'before': ''.join(old_sorted_config),
+        'before': _read_file(destfile),
         'after_header': 'dynamically generated',
-        'after': ''.join(sorted_config),
+        'after': sorted_config,
     }
-    if ''.join(sorted_config) == ''.join(old_sorted_config):
+
+
+def sort_file(params, check_mode=False, diff=False):
+    """Sorts one src file into its dest file.
+
+    This is the body of the module for a single src/dest pair. It has no
+    dependency on AnsibleModule so it can also be run in worker processes.
+
+    Args:
+        params (dict): Module params. ``src`` and ``dest`` are required.
+        check_mode (Optional[bool]): Report what would change, but don't write dest.
+        diff (Optional[bool]): Include the before/after diff in the result.
+
+    Returns:
+        dict: Module result with at least the ``changed`` key set.
+    """
+    srcfile = params['src']
+    destfile = params['dest']
+    order = params.get('order') or 'lexical'
+    timer = _Timer(params.get('stats'))
+    ## Anything that changes the sorted output for the same src has to
+    ## be recorded with the cache and incremental state.
+    options = {'order': order}
+    if os.path.isdir(srcfile):
+        options['regexp'] = params.get('regexp')
+        options['ignore_hidden'] = bool(params.get('ignore_hidden'))
+    if params.get('store'):
+        ## Not part of the output, but a cached run would skip storing it.
+        options['store'] = params['store']
+        store_name = params.get('store_name') or os.path.basename(destfile)
+        ## Checked before anything is written, so a bad name doesn't leave
+        ## dest updated and the manifest missing.
+        try:
+            _manifest_path(params['store'], store_name)
+        except ValueError as e:
+            return {'changed': False, 'failed': True, 'msg': str(e)}
+    cachefile = None
+    if params.get('cache'):
+        cachefile = destfile + CACHE_SUFFIX
+        with timer('cache'):
+            fresh = cache_is_fresh(load_cache(cachefile), srcfile, destfile, options)
+        if fresh:
+            result = {'changed': False, 'cached': True}
+            if timer.enabled:
+                result['stats'] = {'timings': timer.timings}
+            return result
+    ## The src handle is iterated lazily by parse_config so the raw
+    ## config is never held in memory as a whole. Reading src is
+    ## therefore part of the parse stage.
+    src_digest = hashlib.sha1()
+    src_lines = [0]
+    statefile = None
+    previous = None
+    spool = None
+    tree = None
+    if params.get('incremental'):
+        statefile = destfile + STATE_SUFFIX
+        with timer('state_load'):
+            previous = load_state(statefile, options)
+    with timer('parse'):
+        with closing(_open_src(params)) as _:
+            lines = _hash_lines(_, src_digest, src_lines)
+            if statefile:
+                sorted_lines, state = sort_config_incremental(lines, previous, order)
+                output = lambda: iter(sorted_lines)
+            elif (params.get('workers') or 1) > 1:
+                sorted_lines = sort_config_parallel(
+                    lines, params['workers'], order,
+                    params.get('parallel_threshold') or PARALLEL_THRESHOLD)
+                output = lambda: iter(sorted_lines)
+            elif params.get('max_lines'):
+                ## Bounded memory: the sorted output is spooled to a temporary
+                ## file that the digest, diff and write steps read back.
+                spool = tempfile.TemporaryFile(mode='w+', dir=params.get('tmpdir'))
+                spool.writelines(sort_config_external(
+                    lines, params['max_lines'], order, params.get('tmpdir')))
+                def output():
+                    spool.seek(0)
+                    return spool
+            else:
+                tree = parse_config(lines, order)
+                output = lambda: iter_config(tree)
+    result = {}
+    with timer('sort'):
+        out_digest = digest_lines(output())
+    with timer('compare'):
+        dest_digest = digest_file(destfile)
+    if out_digest == dest_digest:
         ## If no changes, return changed=False
         result['changed'] = False
-    elif module.check_mode:
-        ## If changes, return changed=True, but DO NOT change
-        result['changed'] = True
-        result['diff'] = diff
     else:
-        ## If changes, make changes, return changed=True
-        with open(destfile, 'w') as _:
-            _.writelines(sorted_config)
+        ## The diff is only built when asked for (--diff) since it holds
+        ## two full copies of the config and is sent back with the result.
+        if params.get('structured_diff'):
+            with timer('diff'):
+                changes = _diff_dest(destfile, output, order)
+                result['changes'] = changes
+                if diff:
+                    result['diff'] = {'prepared': render_diff(changes, destfile, 'dynamically generated')}
+        elif diff:
+            with timer('diff'):
+                result['diff'] = _make_diff(destfile, ''.join(output()))
+        if not check_mode:
+            ## If changes, make changes, return changed=True
+            ## In check mode, return changed=True, but DO NOT change
+            with timer('write'):
+                write_atomic(destfile, output(), fsync=params.get('fsync'),
+                             preserve=params.get('preserve', True))
         result['changed'] = True
-        result['diff'] = diff
+    if params.get('store') and not check_mode:
+        with timer('store'):
+            if tree is not None:
+                sections = sorted(tree, key=_sortkey)
+            else:
+                sections = _sorted_sections(output(), order)
+            result['store'] = store_config(params['store'], store_name, sections, order)
+    if statefile and not check_mode and _state_changed(previous, state):
+        with timer('state_save'):
+            save_state(statefile, state, options)
+    if timer.enabled:
+        stats = config_stats(output())
+        stats['lines_in'] = src_lines[0]
+        stats['lines_out'] = stats.pop('lines')
+        if os.path.isdir(srcfile):
+            stats['bytes_read'] = sum(os.path.getsize(path) for path in _fragments(
+                srcfile, params.get('regexp'), params.get('ignore_hidden')))
+        else:
+            stats['bytes_read'] = os.path.getsize(srcfile)
+        stats['bytes_written'] = 0
+        if result['changed'] and not check_mode:
+            stats['bytes_written'] = os.path.getsize(destfile)
+        stats['timings'] = timer.timings
+        result['stats'] = stats
+    if spool is not None:
+        spool.close()
+    if cachefile and not check_mode:
+        save_cache(cachefile, srcfile, src_digest.hexdigest(), destfile, out_digest, options)
+    return result
+
+
+def compare_file(params):
+    """Compares src with another config file without writing anything.
+
+    Args:
+        params (dict): Module params. ``src`` and ``compare`` are required.
+
+    Returns:
+        dict: Module result. ``equivalent`` tells whether the two files sort
+            to the same config, ``differences`` holds up to COMPARE_LIMIT of
+            the places where they don't (see :func:`compare_config`; the
+            compare file is the old side) and ``section_hashes`` the hash of
+            each top-level section of src. ``changed`` is always False.
+    """
+    with _open_config(params['compare']) as old:
+        with closing(_open_src(params)) as new:
+            differences, _, hashes = compare_config(
+                old, new, params.get('order') or 'lexical', COMPARE_LIMIT)
+    return {
+        'changed': False,
+        'equivalent': not differences,
+        'differences': differences,
+        'section_hashes': hashes,
+    }
+
+
+def _batch_pairs(params):
+    """Expands the batch params into a list of (src, dest) tuples.
+
+    Args:
+        params (dict): Module params with either ``pairs``, or ``src`` and
+            ``dest`` directories plus a ``glob`` pattern.
+
+    Returns:
+        list: (src, dest) tuples, in a stable order.
+    """
+    if params.get('pairs'):
+        return [(p['src'], p['dest']) for p in params['pairs']]
+    srcdir = params['src']
+    destdir = params['dest']
+    matches = sorted(glob.glob(os.path.join(srcdir, params['glob'])))
+    return [(m, os.path.join(destdir, os.path.relpath(m, srcdir)))
+            for m in matches if os.path.isfile(m)]
+
+
+def _common_dir(paths):
+    """Returns the deepest directory that holds all of paths."""
+    common = None
+    for path in paths:
+        parts = os.path.dirname(os.path.abspath(path)).split(os.sep)
+        if common is None:
+            common = parts
+        while parts[:len(common)] != common:
+            common = common[:-1]
+    return os.sep.join(common) or os.sep
+
+
+def _batch_worker(job):
+    """Runs :func:`sort_file` for one batch entry and times it.
+
+    Errors are returned rather than raised so that one bad file (one that
+    can't be read or decoded, a truncated archive, ...) does not take down
+    the rest of the batch.
+
+    Args:
+        job (tuple): (params, check_mode)
+
+    Returns:
+        dict: The sort_file result plus ``src``, ``dest`` and ``elapsed``.
+    """
+    params, check_mode = job
+    start = time.time()
+    try:
+        destdir = os.path.dirname(params['dest'])
+        if destdir and not check_mode:
+            ## Workers may create the same subdirectory at the same time.
+            _makedirs(destdir)
+        result = sort_file(params, check_mode=check_mode)
+    except Exception as e:
+        result = {'changed': False, 'failed': True, 'msg': '%s: %s' % (type(e).__name__, e)}
+    result['src'] = params['src']
+    result['dest'] = params['dest']
+    result['elapsed'] = round(time.time() - start, 6)
+    return result
+
+
+def sort_batch(params, check_mode=False):
+    """Sorts many src/dest pairs, optionally across a pool of processes.
+
+    Args:
+        params (dict): Module params. See :func:`_batch_pairs` for the
+            src/dest selection. ``workers`` sets the pool size.
+        check_mode (Optional[bool]): Report what would change, but don't write.
+
+    Returns:
+        list: One result dict per pair, in the same order as the pairs.
+    """
+    ## Every job is pickled on its own for the pool, so the batch
+    ## selection (which can list thousands of pairs) is left out of them.
+    shared = dict((k, v) for k, v in params.items() if k not in ('pairs', 'glob'))
+    pairs = _batch_pairs(params)
+    ## Manifests are named after the dest path below the dest directory,
+    ## so that dest files of the same name don't share one.
+    if params.get('pairs'):
+        destdir = _common_dir(dest for src, dest in pairs)
+    else:
+        destdir = params['dest']
+    jobs = []
+    for src, dest in pairs:
+        ## The files are already spread over the pool, so each one is
+        ## sorted serially (pool workers can't start pools of their own).
+        store_name = os.path.relpath(os.path.abspath(dest), os.path.abspath(destdir))
+        job_params = dict(shared, src=src, dest=dest, workers=1, store_name=store_name)
+        jobs.append((job_params, check_mode))
+    workers = min(params.get('workers') or 1, len(jobs))
+    pool = _fork_pool(workers) if workers > 1 else None
+    if pool is None:
+        return [_batch_worker(job) for job in jobs]
+    try:
+        return pool.map(_batch_worker, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_module(params, check_mode=False, diff=False):
+    """Runs the module for a set of params, without AnsibleModule.
+
+    This is shared by :func:`module_main` and the configsort action plugin,
+    which runs the module in-process on the controller.
+
+    Args:
+        params (dict): Module params, with the defaults from ARGUMENT_SPEC.
+        check_mode (Optional[bool]): Report what would change, but don't write.
+        diff (Optional[bool]): Include the diff in the result.
+
+    Returns:
+        dict: Module result. On failure ``failed`` is True and ``msg`` says why.
+    """
+    if params.get('pairs') or params.get('glob'):
+        if params.get('pairs'):
+            for pair in params['pairs']:
+                if not isinstance(pair, dict) or not pair.get('src') or not pair.get('dest'):
+                    return {'failed': True, 'msg': 'each of pairs must be a dict with src and dest, got: %r' % (pair,)}
+        elif params.get('dest') is None:
+            return {'failed': True, 'msg': 'dest is required when glob is set'}
+        elif not os.path.isdir(params['src']):
+            return {'failed': True, 'msg': 'src must be a directory when glob is set'}
+        results = sort_batch(params, check_mode=check_mode)
+        failed = [r for r in results if r.get('failed')]
+        changed = any(r['changed'] for r in results)
+        if failed:
+            return {'failed': True, 'msg': '%d of %d files failed to sort' % (len(failed), len(results)),
+                    'changed': changed, 'results': results}
+        return {'changed': changed, 'results': results}
+    if params.get('compare'):
+        return compare_file(params)
+    if params.get('dest') is None:
+        return {'failed': True, 'msg': 'dest is required'}
+    name = params.get('store_name')
+    if name and (os.sep in name or (os.altsep and os.altsep in name)):
+        return {'failed': True, 'msg': 'store_name must not contain a path separator, got: %s' % name}
+    return sort_file(params, check_mode=check_mode, diff=diff)
+
+
+def module_main(module):
+    """Main Ansible module function.
+
+    This just does Ansible stuff like collect/format args and set
+    value of changed attribute.
+
+    Args:
+        module (ansible.module_utils.basic.AnsibleModule): The base ansible module.
+    """
+    result = run_module(module.params, check_mode=module.check_mode,
+                        diff=getattr(module, '_diff', False))
+    if result.pop('failed', False):
+        module.fail_json(**result)
     module.exit_json(**result)
 
 
+## Module options. Kept at module level so the action plugin can apply
+## the same defaults and types.
+ARGUMENT_SPEC = dict(
+    src=dict(),
+    dest=dict(),
+    cache=dict(default=False, type='bool'),
+    incremental=dict(default=False, type='bool'),
+    structured_diff=dict(default=False, type='bool'),
+    order=dict(default='lexical', choices=sorted(SORT_ORDERS)),
+    pairs=dict(type='list'),
+    glob=dict(),
+    workers=dict(default=1, type='int'),
+    parallel_threshold=dict(default=PARALLEL_THRESHOLD, type='int'),
+    max_lines=dict(default=0, type='int'),
+    stats=dict(default=False, type='bool'),
+    fsync=dict(default=False, type='bool'),
+    preserve=dict(default=True, type='bool'),
+    tmpdir=dict(),
+    compare=dict(),
+    store=dict(),
+    store_name=dict(),
+    regexp=dict(),
+    ignore_hidden=dict(default=False, type='bool'),
+)
+REQUIRED_ONE_OF = [['src', 'pairs']]
+MUTUALLY_EXCLUSIVE = [['src', 'pairs']]
+
+
 def main():
     """Main function for python module.
     """
-    argument_spec = dict(
-        src=dict(required=True),
-        dest=dict(required=True),
-    )
     module = AnsibleModule(
-        argument_spec=argument_spec,
+        argument_spec=ARGUMENT_SPEC,
+        required_one_of=REQUIRED_ONE_OF,
+        mutually_exclusive=MUTUALLY_EXCLUSIVE,
         supports_check_mode=True
     )
     if not REQ_AVAILABLE:
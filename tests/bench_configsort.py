@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for library/configsort.py.
+
+Each generator builds a synthetic config of roughly the requested number
+of lines. For every generator and size, the stages of a sort are timed
+and their peak memory (as seen by tracemalloc) is recorded:
+
+    parse        parse_config(), including insert_sub
+    insert_sub   insert_sub() alone, placing Lineobjs built beforehand
+    emit         get_config() on the parsed tree
+    sort_config  sort_config() end to end
+
+Results can be saved as a baseline and later runs compared against it::
+
+    python tests/bench_configsort.py --save
+    python tests/bench_configsort.py --sizes 10000,100000,1000000,5000000
+
+A stage is reported as a regression if its time or peak memory is more
+than ``--tolerance`` (default 25%) above the baseline, in which case the
+script exits with status 1. Timings are only comparable between runs on
+the same machine, so the baseline also records the platform it came from.
+Python 2 has no tracemalloc, so there only times are measured.
+
+This file is not collected by the test runner.
+"""
+from __future__ import print_function, absolute_import
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    ## Python 2
+    tracemalloc = None
+
+try:
+    ## Python 2: io.StringIO only takes unicode, but files read as str.
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from library.configsort import Lineobj, parse_config, get_config, insert_sub, sort_config
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+DEFAULT_SIZES = [10000, 100000, 1000000]
+
+
+def gen_wide(size, seed=1):
+    """A few huge ACLs and prefix-lists: very wide, two levels deep."""
+    rnd = random.Random(seed)
+    lines = []
+    acls = max(1, size // 40000)
+    per_acl = size // acls - 1
+    for acl in range(acls):
+        lines.append('ip access-list extended ACL-%d\n' % acl)
+        for seq in range(per_acl):
+            lines.append('  %d permit tcp 10.%d.%d.0/24 any eq %d\n' % (
+                (seq + 1) * 10, rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 65535)))
+    return lines
+
+
+def gen_deep(size, seed=2):
+    """Nested routing policy, up to eight levels deep."""
+    rnd = random.Random(seed)
+    lines = []
+    while len(lines) < size:
+        lines.append('policy-options\n')
+        lines.append('  policy-statement PS-%d\n' % rnd.randint(0, size))
+        for term in range(rnd.randint(1, 8)):
+            lines.append('    term T%d\n' % term)
+            lines.append('      from\n')
+            lines.append('        protocol bgp\n')
+            lines.append('        route-filter-list\n')
+            for n in range(rnd.randint(1, 6)):
+                lines.append('          prefix 10.%d.%d.0/24\n' % (term, n))
+                lines.append('            match orlonger\n')
+                lines.append('              then next term\n')
+            lines.append('      then\n')
+            lines.append('        community add C-%d\n' % rnd.randint(0, 100))
+            lines.append('        accept\n')
+    return lines[:size]
+
+
+def gen_duplicates(size, seed=3):
+    """Interfaces that repeat the same handful of child lines, split
+    across duplicate top-level sections."""
+    rnd = random.Random(seed)
+    common = ['  load interval 5\n', '  no shutdown\n', '  mtu 9216\n',
+              '  spanning-tree portfast\n', '  storm-control broadcast level 1\n']
+    lines = []
+    ints = max(1, size // 20)
+    while len(lines) < size:
+        lines.append('interface Ethernet%d\n' % rnd.randint(1, ints))
+        lines.extend(common)
+        lines.append('  description "uplink %d"\n' % rnd.randint(1, 4))
+    return lines[:size]
+
+
+def gen_mixed(size, seed=4):
+    """A mix of IOS-style (``!`` separated), EOS-style (indented) and
+    Junos set-style (flat) lines."""
+    rnd = random.Random(seed)
+    lines = []
+    while len(lines) < size:
+        style = rnd.randint(0, 2)
+        n = rnd.randint(0, size)
+        if style == 0:
+            lines.extend([
+                'router bgp 65000\n',
+                ' neighbor 10.0.%d.%d remote-as %d\n' % (n % 256, n // 256 % 256, 64512 + n % 1000),
+                ' address-family ipv4\n',
+                '  neighbor 10.0.%d.%d activate\n' % (n % 256, n // 256 % 256),
+                '!\n',
+            ])
+        elif style == 1:
+            lines.extend([
+                'interface Ethernet%d/%d\n' % (n % 48 + 1, n // 48 % 4 + 1),
+                '   description host-%d\n' % n,
+                '   switchport access vlan %d\n' % (n % 4094 + 1),
+            ])
+        else:
+            lines.append('set interfaces xe-0/0/%d unit 0 family inet address 10.%d.%d.1/30\n' % (
+                n % 48, n % 256, n // 256 % 256))
+    return lines[:size]
+
+
+GENERATORS = {
+    'wide': gen_wide,
+    'deep': gen_deep,
+    'duplicates': gen_duplicates,
+    'mixed': gen_mixed,
+}
+
+
+def _stages(lines):
+    """Returns the (name, callable) stages to measure for lines.
+
+    The parsing stages read from a StringIO, like config_sort reads from a
+    file handle, so every line is a fresh string allocated during the stage
+    rather than one shared with the generator's list.
+
+    The insert_sub stage gets its Lineobjs built here, outside the stage,
+    and handles top-level lines the way parse_config does: duplicates are
+    merged through a dict, so the subs of every copy go into one tree.
+    """
+    text = ''.join(lines)
+    sources = {'parse': StringIO(text), 'sort_config': StringIO(text)}
+    lineobjs = [Lineobj(line) for line in lines if line.strip()]
+    state = {}
+    def parse():
+        state['tree'] = parse_config(sources['parse'])
+    def insert():
+        tops = {}
+        currlevel = []
+        for lineobj in lineobjs:
+            if lineobj.indent:
+                insert_sub(currlevel, lineobj)
+            else:
+                currlevel = [tops.setdefault(lineobj.text, lineobj)]
+    def emit():
+        get_config(state['tree'])
+    def sort():
+        sort_config(sources['sort_config'])
+    return [('parse', parse), ('insert_sub', insert), ('emit', emit), ('sort_config', sort)]
+
+
+def measure(lines, memory=True):
+    """Times each stage, then repeats it under tracemalloc for peak memory.
+
+    Timing and memory are measured in separate passes because tracemalloc
+    slows allocation-heavy code down considerably.
+
+    Returns:
+        dict: stage name -> {'seconds': float, 'peak_kb': int or None}
+    """
+    results = {}
+    for name, stage in _stages(lines):
+        gc.collect()
+        start = time.time()
+        stage()
+        results[name] = {'seconds': round(time.time() - start, 4), 'peak_kb': None}
+    if memory:
+        for name, stage in _stages(lines):
+            gc.collect()
+            tracemalloc.start()
+            stage()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[name]['peak_kb'] = peak // 1024
+    return results
+
+
+def compare(results, baseline, tolerance, min_seconds=0.05):
+    """Lists the measurements that regressed against the baseline.
+
+    Stages that took less than min_seconds in the baseline are too noisy
+    to compare on time, so only their memory is checked.
+
+    Returns:
+        list: Human readable regression messages.
+    """
+    regressions = []
+    for key, stages in sorted(results.items()):
+        for name, now in sorted(stages.items()):
+            then = baseline.get(key, {}).get(name)
+            if then is None:
+                continue
+            for field in ('seconds', 'peak_kb'):
+                if now[field] is None or not then.get(field):
+                    continue
+                if field == 'seconds' and then[field] < min_seconds:
+                    continue
+                if now[field] > then[field] * (1 + tolerance):
+                    regressions.append('%s %s %s: %s -> %s' % (key, name, field, then[field], now[field]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help='comma separated line counts (default: %(default)s)')
+    parser.add_argument('--generators', default=','.join(sorted(GENERATORS)),
+                        help='comma separated generators (default: %(default)s)')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file (default: %(default)s)')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed regression as a fraction (default: %(default)s)')
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help='skip time comparisons for faster stages (default: %(default)s)')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the tracemalloc pass')
+    args = parser.parse_args(argv)
+    if args.memory and tracemalloc is None:
+        print('tracemalloc is not available, measuring times only')
+        args.memory = False
+
+    results = {}
+    for gen in args.generators.split(','):
+        for size in [int(s) for s in args.sizes.split(',')]:
+            lines = GENERATORS[gen](size)
+            key = '%s:%d' % (gen, size)
+            results[key] = measure(lines, args.memory)
+            for name, r in sorted(results[key].items()):
+                print('%-20s %-12s %10.4fs %10s KB' % (key, name, r['seconds'], r['peak_kb']))
+            del lines
+
+    machine = '%s %s / Python %s' % (platform.system(), platform.machine(), platform.python_version())
+    if args.save:
+        baseline = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as _:
+                baseline = json.load(_)
+        baseline['machine'] = machine
+        baseline.setdefault('results', {}).update(results)
+        with open(args.baseline, 'w') as _:
+            json.dump(baseline, _, indent=2, sort_keys=True)
+        print('saved baseline to %s' % args.baseline)
+        return 0
+    if not os.path.isfile(args.baseline):
+        print('no baseline at %s; run with --save to create one' % args.baseline)
+        return 0
+    with open(args.baseline) as _:
+        baseline = json.load(_)
+    if baseline.get('machine') != machine:
+        print('warning: baseline was recorded on %s, this is %s' % (baseline.get('machine'), machine))
+    regressions = compare(results, baseline.get('results', {}), args.tolerance, args.min_seconds)
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
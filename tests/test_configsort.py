@@ -2,7 +2,45 @@
 from __future__ import print_function, absolute_import
 
 import unittest
-from library.configsort import sort_config
+import contextlib
+import multiprocessing
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import yaml
+from library import configsort
+from library.configsort import sort_config, parse_config, iter_config
+from library.configsort import digest_lines, digest_file
+from library.configsort import load_cache, save_cache, cache_is_fresh
+from library.configsort import sort_batch, sort_config_incremental, sort_config_parallel
+from library.configsort import sort_config_external, config_stats, write_atomic
+from library.configsort import sort_file
+from library.configsort import diff_config, render_diff, natural_key
+from library.configsort import hash_tree, section_hashes, compare_config
+from library.configsort import store_config, restore_config, diff_stored
+from action_plugins.configsort import _check_args, ActionModule
+from action_plugins import configsort as configsort_action
+from filter_plugins import configsort as configsort_filter
+
+@contextlib.contextmanager
+def start_method(method):
+    """Sets the default multiprocessing start method for a block."""
+    previous = multiprocessing.get_start_method(allow_none=True)
+    multiprocessing.set_start_method(method, force=True)
+    try:
+        yield
+    finally:
+        multiprocessing.set_start_method(previous, force=True)
+
+class DocumentationTestCase(unittest.TestCase):
+
+    def test_options_are_documented(self):
+        doc = yaml.safe_load(configsort.DOCUMENTATION)
+        self.assertEqual(sorted(doc['options']), sorted(configsort.ARGUMENT_SPEC), '')
+        for name, option in doc['options'].items():
+            self.assertTrue(option.get('description'), '%s has no description' % name)
 
 class SortTestCase(unittest.TestCase):
 
@@ -155,6 +193,759 @@ interface eth 3
         sorted_config = sort_config(orig_config.split('\n'))
         self.assertEqual('\n'.join(sorted_config), exp_config, '')
 
+    def test_wide_duplicate_sub_level(self):
+        orig_config = ['ip prefix-list BIG']
+        for n in (3, 1, 2, 1, 3):
+            orig_config.append('  seq %s permit 10.0.%s.0/24' % (n, n))
+        exp_config = [
+            'ip prefix-list BIG',
+            '  seq 1 permit 10.0.1.0/24',
+            '  seq 2 permit 10.0.2.0/24',
+            '  seq 3 permit 10.0.3.0/24',
+        ]
+        self.assertEqual(sort_config(orig_config), exp_config, '')
+
+    def test_deeper_than_recursion_limit(self):
+        depth = sys.getrecursionlimit() + 100
+        orig_config = ['%sb %s' % (' ' * n, n) for n in range(depth)]
+        orig_config.append(' a 1')
+        sorted_config = sort_config(orig_config)
+        self.assertEqual(len(sorted_config), depth + 1, '')
+        self.assertEqual(sorted_config[:2], ['b 0', ' a 1'], '')
+        self.assertEqual(sorted_config[-1], '%sb %s' % (' ' * (depth - 1), depth - 1), '')
+
+    def test_repeated_lines_are_interned(self):
+        config = ['interface eth %d\n' % n for n in range(3)]
+        config = [line for top in config for line in (top, ''.join(['  no ', 'shutdown\n']))]
+        subs = [top.subs[0].text for top in parse_config(config)]
+        self.assertTrue(subs[0] is subs[1] and subs[1] is subs[2], '')
+        limit = configsort.INTERN_LIMIT
+        configsort.INTERN_LIMIT = 0
+        try:
+            subs = [top.subs[0].text for top in parse_config(config)]
+            self.assertFalse(subs[0] is subs[1], '')
+        finally:
+            configsort.INTERN_LIMIT = limit
+
+    def test_iter_config_is_lazy(self):
+        tree = parse_config(['b', ' y', ' x', 'a'])
+        gen = iter_config(tree)
+        self.assertEqual(next(gen), 'a', '')
+        self.assertEqual(list(gen), ['b', ' x', ' y'], '')
+
+class NaturalSortTestCase(unittest.TestCase):
+
+    orig_config = [
+        'interface eth 10', '  mtu 9216',
+        'interface eth 2', '  vlan 100', '  vlan 20',
+        'interface eth 1',
+    ]
+
+    def test_natural_key(self):
+        self.assertTrue(natural_key('eth 2') < natural_key('eth 10'))
+        self.assertTrue(natural_key('eth 01') < natural_key('eth 1'))
+        self.assertTrue(natural_key('eth') < natural_key('eth 1'))
+        self.assertTrue(natural_key('   b') < natural_key('  10'))
+
+    def test_natural_sort_parses_back(self):
+        config = ['r', '   b', '  10', '    x']
+        sorted_config = sort_config(config, 'natural')
+        self.assertEqual(sort_config(sorted_config, 'natural'), sorted_config, '')
+        self.assertEqual(compare_config(config, sorted_config, 'natural')[0], [], '')
+        self.assertEqual(diff_config(sorted_config, sorted_config, 'natural'), [], '')
+        self.assertEqual(list(sort_config_external(config, 1, 'natural')), sorted_config, '')
+
+    def test_lexical_is_default(self):
+        self.assertEqual(sort_config(self.orig_config)[:3],
+                         ['interface eth 1', 'interface eth 10', '  mtu 9216'], '')
+
+    def test_natural_sort(self):
+        self.assertEqual(sort_config(self.orig_config, 'natural'), [
+            'interface eth 1',
+            'interface eth 2', '  vlan 20', '  vlan 100',
+            'interface eth 10', '  mtu 9216',
+        ], '')
+
+    def test_natural_incremental_and_diff(self):
+        sorted_config, state = sort_config_incremental(self.orig_config, order='natural')
+        self.assertEqual(sorted_config, sort_config(self.orig_config, 'natural'), '')
+        new_config = sort_config(self.orig_config + ['interface eth 9'], 'natural')
+        self.assertEqual(diff_config(sorted_config, new_config, 'natural'),
+                         [{'path': [], 'removed': [], 'added': ['interface eth 9']}], '')
+
+class IncrementalTestCase(unittest.TestCase):
+
+    orig_config = [
+        'interface eth 3', '  load interval 5',
+        'interface eth 1', '  ip address 1.1.1.1/32', '  ip ospf', '    passive', '    area 0',
+        'interface eth 3', '  ip address 3.3.3.3/32',
+        'router ospf', '  area 0', '',
+    ]
+
+    def test_matches_sort_config(self):
+        sorted_config, state = sort_config_incremental(self.orig_config)
+        self.assertEqual(sorted_config, sort_config(self.orig_config), '')
+
+    def test_unchanged_sections_are_reused(self):
+        sorted_config, state = sort_config_incremental(self.orig_config)
+        new_config = self.orig_config + ['router ospf', '  area 1']
+        new_sorted, new_state = sort_config_incremental(new_config, state)
+        self.assertEqual(new_sorted, sort_config(new_config), '')
+        self.assertTrue(new_state['interface eth 1'] is state['interface eth 1'])
+        self.assertTrue(new_state['interface eth 3'] is state['interface eth 3'])
+        self.assertFalse(new_state['router ospf'] is state['router ospf'])
+
+    def test_removed_sections_are_dropped(self):
+        sorted_config, state = sort_config_incremental(self.orig_config)
+        new_config = self.orig_config[:9]
+        new_sorted, new_state = sort_config_incremental(new_config, state)
+        self.assertEqual(new_sorted, sort_config(new_config), '')
+        self.assertFalse('router ospf' in new_state)
+
+    def test_state_is_only_saved_when_a_section_changes(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmpdir, 'src.conf')
+            dest = os.path.join(tmpdir, 'dest.conf')
+            write_atomic(src, [line + '\n' for line in self.orig_config])
+            params = {'src': src, 'dest': dest, 'incremental': True, 'stats': True}
+            timings = sort_file(params)['stats']['timings']
+            self.assertTrue('state_load' in timings and 'state_save' in timings, timings)
+            os.utime(dest + '.sortstate', (0, 0))
+            timings = sort_file(params)['stats']['timings']
+            self.assertTrue('state_load' in timings and 'state_save' not in timings, timings)
+            self.assertEqual(os.path.getmtime(dest + '.sortstate'), 0, '')
+            write_atomic(src, [line + '\n' for line in self.orig_config + ['router bgp']])
+            self.assertTrue('state_save' in sort_file(params)['stats']['timings'])
+            self.assertNotEqual(os.path.getmtime(dest + '.sortstate'), 0, '')
+        finally:
+            shutil.rmtree(tmpdir)
+
+class ParallelTestCase(unittest.TestCase):
+
+    orig_config = []
+    for n in (3, 1, 2, 1):
+        orig_config.extend(['interface eth %s' % n, '  mtu %s' % n, '  ip ospf', '    area %s' % n])
+
+    def test_matches_serial(self):
+        for order in ('lexical', 'natural'):
+            self.assertEqual(sort_config_parallel(self.orig_config, 2, order, threshold=0),
+                             sort_config(self.orig_config, order), '')
+
+    def test_below_threshold(self):
+        self.assertEqual(sort_config_parallel(self.orig_config, 2),
+                         sort_config(self.orig_config), '')
+
+    @unittest.skipIf(not hasattr(multiprocessing, 'set_start_method'), 'Python 2 always forks')
+    def test_forks_under_other_start_methods(self):
+        ## Loaded by the action plugin, the module can't be imported by name
+        ## in spawned workers.
+        loaded = configsort_action._configsort()
+        with start_method('spawn'):
+            self.assertEqual(loaded.sort_config_parallel(self.orig_config, 2, threshold=0),
+                             sort_config(self.orig_config), '')
+
+class ExternalSortTestCase(unittest.TestCase):
+
+    orig_config = []
+    for n in (3, 1, 2, 1, 3, 2):
+        orig_config.extend(['interface eth %s' % n, '  mtu %s' % n, '  ip ospf', '    area %s' % n])
+    orig_config.extend(['', '  orphan', 'router bgp', '  neighbor 1'])
+
+    def test_spilled_runs_match_sort_config(self):
+        for max_lines in (1, 4, 9):
+            for order in ('lexical', 'natural'):
+                self.assertEqual(list(sort_config_external(self.orig_config, max_lines, order)),
+                                 sort_config(self.orig_config, order), '')
+
+    def test_fits_in_memory(self):
+        self.assertEqual(list(sort_config_external(self.orig_config, 1000)),
+                         sort_config(self.orig_config), '')
+
+class DiffTestCase(unittest.TestCase):
+
+    old_config = sort_config([
+        'interface eth 1', '  ip ospf', '    area 0', '    passive', '  mtu 1500',
+        'interface eth 2', '  shutdown',
+        'router bgp',
+    ])
+    new_config = sort_config([
+        'interface eth 1', '  ip ospf', '    area 1', '    passive', '  mtu 1500',
+        'interface eth 3', '  shutdown',
+        'router bgp', '  neighbor 1.1.1.1',
+    ])
+
+    def test_identical(self):
+        self.assertEqual(diff_config(self.old_config, list(self.old_config)), [], '')
+
+    def test_changes(self):
+        changes = diff_config(self.old_config, self.new_config)
+        self.assertEqual(changes, [
+            {'path': [], 'removed': ['interface eth 2', '  shutdown'],
+             'added': ['interface eth 3', '  shutdown']},
+            {'path': ['interface eth 1', '  ip ospf'], 'removed': ['    area 0'],
+             'added': ['    area 1']},
+            {'path': ['router bgp'], 'removed': [], 'added': ['  neighbor 1.1.1.1']},
+        ], '')
+
+    def test_render(self):
+        rendered = render_diff(diff_config(self.old_config, self.new_config))
+        self.assertTrue('@@ interface eth 1 > ip ospf @@\n interface eth 1\n   ip ospf\n'
+                        '-    area 0\n+    area 1\n' in rendered)
+        self.assertEqual(render_diff([]), '', '')
+
+    def test_unsorted_input(self):
+        self.assertRaises(ValueError, diff_config, ['b', 'a'], ['a', 'b'])
+        self.assertRaises(ValueError, diff_config, ['a', ' x', 'c', 'b'], ['a', ' x', 'b', 'c'])
+
+    def test_common_parents(self):
+        old_config = ['r 1', ' a', '  x', ' b', 'r 2', ' a', '  x', ' b']
+        new_config = ['r 1', ' a', '  x', ' b', 'r 2', ' a', '  y', ' b']
+        self.assertEqual(diff_config(old_config, new_config, 'natural'),
+                         [{'path': ['r 2', ' a'], 'removed': ['  x'], 'added': ['  y']}], '')
+        self.assertEqual(diff_config(old_config, old_config[:4]),
+                         [{'path': [], 'removed': ['r 2', ' a', '  x', ' b'], 'added': []}], '')
+
+class CompareTestCase(unittest.TestCase):
+
+    old_config = [
+        'interface eth 1', '  ip ospf', '    area 0', '    passive', '  mtu 1500',
+        'interface eth 2', '  shutdown',
+        'router bgp',
+    ]
+
+    def test_hash_ignores_order(self):
+        shuffled = ['router bgp', 'interface eth 2', '  shutdown',
+                    'interface eth 1\r\n', '  mtu 1500', '  ip ospf', '    passive', '    area 0']
+        self.assertEqual(section_hashes(hash_tree(parse_config(self.old_config))),
+                         section_hashes(hash_tree(parse_config(shuffled))), '')
+
+    def test_equivalent(self):
+        differences, old_hashes, new_hashes = compare_config(
+            self.old_config, sort_config(self.old_config), 'natural')
+        self.assertEqual(differences, [], '')
+        self.assertEqual(old_hashes, new_hashes, '')
+        self.assertEqual(sorted(old_hashes), ['interface eth 1', 'interface eth 2', 'router bgp'], '')
+
+    def test_differences(self):
+        new_config = [
+            'interface eth 1', '  ip ospf', '    area 1', '    passive', '  mtu 1500',
+            'interface eth 3', '  shutdown',
+            'router bgp', '  neighbor 1.1.1.1',
+        ]
+        differences, old_hashes, new_hashes = compare_config(self.old_config, new_config)
+        self.assertEqual(differences, [
+            {'path': [], 'removed': ['interface eth 2'], 'added': ['interface eth 3']},
+            {'path': ['interface eth 1', '  ip ospf'], 'removed': ['    area 0'],
+             'added': ['    area 1']},
+            {'path': ['router bgp'], 'removed': [], 'added': ['  neighbor 1.1.1.1']},
+        ], '')
+        self.assertNotEqual(old_hashes['router bgp'], new_hashes['router bgp'], '')
+        self.assertEqual(len(compare_config(self.old_config, new_config, limit=2)[0]), 2, '')
+
+    def test_line_endings(self):
+        self.assertEqual(compare_config(['a\n', ' b\n', 'a\n', ' b'], ['a\r\n', ' b\n'])[0], [], '')
+        self.assertEqual(compare_config(['a\n', ' b\n', 'a\n', ' b'], ['a\n', ' c\n'])[0],
+                         [{'path': ['a'], 'removed': [' b'], 'added': [' c']}], '')
+
+class StoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.configs = {
+            'r1': ['ntp server 1.1.1.1\n', 'snmp\n', '  community public\n', 'hostname r1\n'],
+            'r2': ['snmp\n', '  community public\n', 'hostname r2\n', 'ntp server 1.1.1.1\n'],
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_shared_sections_are_stored_once(self):
+        first = store_config(self.tmpdir, 'r1', parse_config(self.configs['r1']))
+        second = store_config(self.tmpdir, 'r2', parse_config(self.configs['r2']))
+        self.assertEqual((first['sections'], first['new']), (3, 3), '')
+        self.assertEqual((second['sections'], second['new']), (3, 1), '')
+        objects = [f for _, _, files in os.walk(os.path.join(self.tmpdir, 'objects')) for f in files]
+        self.assertEqual(len(objects), 4, '')
+
+    def test_restore_and_diff(self):
+        for name, config in self.configs.items():
+            store_config(self.tmpdir, name, sorted(parse_config(config), key=lambda l: l.key))
+        for name, config in self.configs.items():
+            self.assertEqual(list(restore_config(self.tmpdir, name)), sort_config(config), '')
+        self.assertEqual(diff_stored(self.tmpdir, 'r1', 'r2'),
+                         [{'path': [], 'removed': ['hostname r1\n'], 'added': ['hostname r2\n']}], '')
+        self.assertRaises(IOError, list, restore_config(self.tmpdir, 'r3'))
+
+    def test_names_stay_in_the_store(self):
+        store = os.path.join(self.tmpdir, 'store')
+        self.assertRaises(ValueError, store_config, store, '../../escape', [])
+        srcfile = os.path.join(self.tmpdir, 'r1.conf')
+        write_atomic(srcfile, self.configs['r1'])
+        result = configsort.run_module({'src': srcfile, 'dest': srcfile + '.sorted',
+                                        'store': store, 'store_name': '../../escape'})
+        self.assertTrue(result['failed'], '')
+        self.assertEqual(os.listdir(self.tmpdir), ['r1.conf'], '')
+        result = sort_file({'src': srcfile, 'dest': srcfile + '.sorted',
+                            'store': store, 'store_name': '../../escape'})
+        self.assertTrue(result['failed'], '')
+        self.assertEqual(os.listdir(self.tmpdir), ['r1.conf'], '')
+
+    def test_unnormalised_store_path(self):
+        srcfile = os.path.join(self.tmpdir, 'r1.conf')
+        write_atomic(srcfile, self.configs['r1'])
+        for store in (os.path.join(self.tmpdir, '.', 'store'), self.tmpdir + os.sep + os.sep + 'store'):
+            result = sort_file({'src': srcfile, 'dest': srcfile + '.sorted', 'store': store})
+            self.assertFalse(result.get('failed'), result)
+            self.assertEqual(list(restore_config(store, 'r1.conf.sorted')),
+                             sort_config(self.configs['r1']), '')
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        try:
+            result = sort_file({'src': 'r1.conf', 'dest': 'r1.conf.sorted', 'store': './store'})
+        finally:
+            os.chdir(cwd)
+        self.assertFalse(result.get('failed'), result)
+
+    def test_batch_manifests_by_dest_path(self):
+        srcdir = os.path.join(self.tmpdir, 'src')
+        os.makedirs(os.path.join(srcdir, 'site1'))
+        os.makedirs(os.path.join(srcdir, 'site2'))
+        for site, name in (('site1', 'r1'), ('site2', 'r1'), ('site2', 'r2')):
+            write_atomic(os.path.join(srcdir, site, name + '.conf'), self.configs[name])
+        store = os.path.join(self.tmpdir, 'store')
+        destdir = os.path.join(self.tmpdir, 'dest')
+        sort_batch({'src': srcdir, 'dest': destdir, 'glob': '*/*.conf', 'store': store})
+        for site, name in (('site1', 'r1'), ('site2', 'r1'), ('site2', 'r2')):
+            self.assertEqual(list(restore_config(store, os.path.join(site, name + '.conf'))),
+                             sort_config(self.configs[name]), '')
+        sort_batch({'pairs': [
+            {'src': os.path.join(srcdir, 'site1', 'r1.conf'), 'dest': os.path.join(destdir, 'a', 'r.conf')},
+            {'src': os.path.join(srcdir, 'site2', 'r2.conf'), 'dest': os.path.join(destdir, 'b', 'r.conf')},
+        ], 'store': store})
+        self.assertEqual(list(restore_config(store, os.path.join('b', 'r.conf'))),
+                         sort_config(self.configs['r2']), '')
+
+class StatsTestCase(unittest.TestCase):
+
+    def test_config_stats(self):
+        sorted_config = sort_config([
+            'interface eth 1', '  ip ospf', '    area 0', '    passive', '  mtu 1500',
+            'router bgp', '  neighbor 1', '  neighbor 2', '  neighbor 3',
+        ])
+        self.assertEqual(config_stats(sorted_config), {
+            'lines': 9, 'sections': 2, 'max_depth': 3,
+            'widest': {'line': 'router bgp', 'subs': 3},
+        }, '')
+
+    def test_timings(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmpdir, 'src.conf')
+            write_atomic(src, ['b\n', 'a\n'])
+            params = {'src': src, 'dest': os.path.join(tmpdir, 'dest.conf'), 'stats': True}
+            timings = sort_file(params, check_mode=True)['stats']['timings']
+            self.assertEqual(sorted(timings), ['compare', 'parse', 'sort'], '')
+            timings = sort_file(params, check_mode=True, diff=True)['stats']['timings']
+            self.assertEqual(sorted(timings), ['compare', 'diff', 'parse', 'sort'], '')
+        finally:
+            shutil.rmtree(tmpdir)
+
+class DigestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_digest_file_matches_digest_lines(self):
+        sorted_config = sort_config(['b\n', ' y\n', ' x\n', 'a\n'])
+        path = os.path.join(self.tmpdir, 'sorted.conf')
+        with open(path, 'w') as _:
+            _.writelines(sorted_config)
+        self.assertEqual(digest_file(path), digest_lines(sorted_config), '')
+
+    def test_missing_file_digest_is_empty(self):
+        path = os.path.join(self.tmpdir, 'missing.conf')
+        self.assertEqual(digest_file(path), digest_lines([]), '')
+
+class WriteTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmpdir, 'dest.conf')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_write_atomic(self):
+        write_atomic(self.dest, ['a\n', 'b\n'], fsync=True)
+        with open(self.dest) as _:
+            self.assertEqual(_.read(), 'a\nb\n', '')
+        self.assertEqual(os.listdir(self.tmpdir), ['dest.conf'], '')
+
+    def test_preserve_mode(self):
+        with open(self.dest, 'w') as _:
+            _.write('old\n')
+        os.chmod(self.dest, 0o640)
+        write_atomic(self.dest, ['new\n'])
+        self.assertEqual(stat.S_IMODE(os.stat(self.dest).st_mode), 0o640)
+        write_atomic(self.dest, ['new\n'], preserve=False)
+        self.assertNotEqual(stat.S_IMODE(os.stat(self.dest).st_mode), 0o640)
+
+    def test_symlink_target_is_replaced(self):
+        target = os.path.join(self.tmpdir, 'target.conf')
+        with open(target, 'w') as _:
+            _.write('old\n')
+        os.symlink(target, self.dest)
+        write_atomic(self.dest, ['new\n'])
+        self.assertTrue(os.path.islink(self.dest))
+        with open(target) as _:
+            self.assertEqual(_.read(), 'new\n', '')
+
+class CompressionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = ['interface eth 2\n', '  shutdown\n', 'interface eth 1\n']
+        self.src = os.path.join(self.tmpdir, 'src.conf.gz')
+        write_atomic(self.src, self.config)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_compressed_src_and_dest(self):
+        for ext in ('.gz', '.bz2', '.xz'):
+            if ext == '.xz' and configsort.lzma is None:
+                ## Python 2 has no lzma.
+                continue
+            dest = os.path.join(self.tmpdir, 'dest.conf' + ext)
+            self.assertTrue(sort_file({'src': self.src, 'dest': dest})['changed'])
+            self.assertEqual(digest_file(dest), digest_lines(sort_config(self.config)), '')
+            self.assertFalse(sort_file({'src': self.src, 'dest': dest})['changed'])
+
+    def test_gzip_is_reproducible(self):
+        dest = os.path.join(self.tmpdir, 'dest.conf.gz')
+        write_atomic(dest, self.config)
+        with open(dest, 'rb') as _:
+            first = _.read()
+        write_atomic(dest, self.config)
+        with open(dest, 'rb') as _:
+            self.assertEqual(_.read(), first, '')
+
+class FragmentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'fragments')
+        os.mkdir(self.srcdir)
+        for name, text in (('10.fragment', 'interface eth 2\n  shutdown'),
+                           ('20.fragment', 'interface eth 1\n'),
+                           ('.30.fragment', 'hidden\n'),
+                           ('README', 'not config\n')):
+            with open(os.path.join(self.srcdir, name), 'w') as _:
+                _.write(text)
+        self.dest = os.path.join(self.tmpdir, 'dest.conf')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_assemble_and_sort(self):
+        params = {'src': self.srcdir, 'dest': self.dest, 'regexp': r'\.fragment$',
+                  'ignore_hidden': True, 'cache': True}
+        self.assertTrue(sort_file(params)['changed'])
+        with open(self.dest) as _:
+            self.assertEqual(_.read(), 'interface eth 1\ninterface eth 2\n  shutdown\n', '')
+        self.assertTrue(sort_file(params).get('cached'))
+        with open(os.path.join(self.srcdir, '20.fragment'), 'a') as _:
+            _.write('  mtu 1500\n')
+        self.assertTrue(sort_file(params)['changed'])
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src.conf')
+        self.dest = os.path.join(self.tmpdir, 'dest.conf')
+        self.cachefile = self.dest + '.sortcache'
+        with open(self.src, 'w') as _:
+            _.write('b\n a\n')
+        with open(self.dest, 'w') as _:
+            _.write('b\n a\n')
+        save_cache(self.cachefile, self.src, digest_file(self.src),
+                   self.dest, digest_file(self.dest))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_fresh_cache(self):
+        self.assertTrue(cache_is_fresh(load_cache(self.cachefile), self.src, self.dest))
+
+    def test_touched_src_with_same_content(self):
+        os.utime(self.src, (0, 0))
+        self.assertTrue(cache_is_fresh(load_cache(self.cachefile), self.src, self.dest))
+
+    def test_changed_src(self):
+        with open(self.src, 'w') as _:
+            _.write('b\n c\n')
+        os.utime(self.src, (0, 0))
+        self.assertFalse(cache_is_fresh(load_cache(self.cachefile), self.src, self.dest))
+
+    def test_changed_dest(self):
+        with open(self.dest, 'a') as _:
+            _.write('c\n')
+        self.assertFalse(cache_is_fresh(load_cache(self.cachefile), self.src, self.dest))
+
+    def test_other_cache_version(self):
+        with open(self.cachefile, 'w') as _:
+            _.write('{"version": 0}')
+        self.assertEqual(load_cache(self.cachefile), None, '')
+
+    def test_version_follows_the_source(self):
+        import hashlib
+        path = configsort.__file__
+        if path.endswith('.pyc'):
+            path = path[:-1]
+        with open(path, 'rb') as _:
+            self.assertEqual(configsort.CACHE_VERSION, hashlib.sha1(_.read()).hexdigest(), '')
+        version = configsort.CACHE_VERSION
+        try:
+            configsort.CACHE_VERSION = None
+            self.assertEqual(load_cache(self.cachefile), None, '')
+        finally:
+            configsort.CACHE_VERSION = version
+
+    def test_version_from_a_zip(self):
+        import hashlib
+        import importlib
+        import zipfile
+        path = configsort.__file__
+        if path.endswith('.pyc'):
+            path = path[:-1]
+        with open(path, 'rb') as _:
+            source = _.read()
+        archive = os.path.join(self.tmpdir, 'payload.zip')
+        with zipfile.ZipFile(archive, 'w') as _:
+            _.writestr('zipped_configsort.py', source)
+        sys.path.insert(0, archive)
+        try:
+            zipped = importlib.import_module('zipped_configsort')
+        finally:
+            sys.path.remove(archive)
+            sys.modules.pop('zipped_configsort', None)
+        self.assertTrue(zipped.__file__.startswith(archive), zipped.__file__)
+        self.assertEqual(zipped.CACHE_VERSION, hashlib.sha1(source).hexdigest(), '')
+        ## AnsiballZ runs the module from its zip as __main__.
+        zipped.__name__ = '__main__'
+        self.assertEqual(zipped._source_version(), zipped.CACHE_VERSION, '')
+
+class BatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        self.destdir = os.path.join(self.tmpdir, 'dest')
+        os.mkdir(self.srcdir)
+        for n in range(4):
+            with open(os.path.join(self.srcdir, 'host%s.conf' % n), 'w') as _:
+                _.write('router %s\n  b\n  a\n' % n)
+        with open(os.path.join(self.srcdir, 'README'), 'w') as _:
+            _.write('not a config\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_glob_with_workers(self):
+        params = {'src': self.srcdir, 'dest': self.destdir, 'glob': '*.conf', 'workers': 2}
+        results = sort_batch(params)
+        self.assertEqual([os.path.basename(r['dest']) for r in results],
+                         ['host0.conf', 'host1.conf', 'host2.conf', 'host3.conf'], '')
+        self.assertTrue(all(r['changed'] for r in results))
+        with open(os.path.join(self.destdir, 'host2.conf')) as _:
+            self.assertEqual(_.read(), 'router 2\n  a\n  b\n', '')
+        results = sort_batch(params)
+        self.assertFalse(any(r['changed'] for r in results))
+
+    @unittest.skipIf(not hasattr(multiprocessing, 'set_start_method'), 'Python 2 always forks')
+    def test_plugin_loaded_module_under_spawn(self):
+        loaded = configsort_action._configsort()
+        params = {'src': self.srcdir, 'dest': self.destdir, 'glob': '*.conf', 'workers': 2}
+        with start_method('spawn'):
+            result = loaded.run_module(params)
+        self.assertFalse(result.get('failed'), result)
+        self.assertEqual(len(result['results']), 4, '')
+        with open(os.path.join(self.destdir, 'host2.conf')) as _:
+            self.assertEqual(_.read(), 'router 2\n  a\n  b\n', '')
+
+    def test_pairs_report_failures(self):
+        params = {'pairs': [
+            {'src': os.path.join(self.srcdir, 'host0.conf'), 'dest': os.path.join(self.tmpdir, 'a.conf')},
+            {'src': os.path.join(self.srcdir, 'missing.conf'), 'dest': os.path.join(self.tmpdir, 'b.conf')},
+        ]}
+        results = sort_batch(params, check_mode=True)
+        self.assertTrue(results[0]['changed'])
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'a.conf')))
+        self.assertTrue(results[1]['failed'])
+
+    def test_bad_file_does_not_stop_the_batch(self):
+        truncated = os.path.join(self.srcdir, 'host9.conf.gz')
+        write_atomic(truncated, ['router 9\n'] * 1000)
+        with open(truncated, 'rb+') as _:
+            _.truncate(20)
+        params = {'pairs': [
+            {'src': truncated, 'dest': os.path.join(self.tmpdir, 'a.conf')},
+            {'src': os.path.join(self.srcdir, 'host0.conf'), 'dest': os.path.join(self.tmpdir, 'b.conf')},
+        ]}
+        results = sort_batch(params)
+        self.assertTrue(results[0]['failed'])
+        self.assertTrue(results[1]['changed'])
+
+    def test_bad_batch_params(self):
+        src = os.path.join(self.srcdir, 'host0.conf')
+        for params in ({'pairs': [{'src': src}]},
+                       {'pairs': [src]},
+                       {'src': self.srcdir, 'glob': '*.conf', 'dest': None}):
+            result = configsort.run_module(params)
+            self.assertTrue(result['failed'], params)
+            self.assertTrue('dest' in result['msg'], params)
+
+class ActionPluginTestCase(unittest.TestCase):
+
+    def test_defaults_and_types(self):
+        params, msg = _check_args({'src': 'a', 'dest': 'b', 'cache': 'yes', 'workers': '4'})
+        self.assertEqual(msg, None, '')
+        self.assertEqual((params['cache'], params['workers'], params['preserve'], params['order']),
+                         (True, 4, True, 'lexical'), '')
+
+    def test_invalid_args(self):
+        self.assertTrue('src, pairs' in _check_args({'dest': 'b'})[1])
+        self.assertTrue('mutually exclusive' in _check_args({'src': 'a', 'pairs': []})[1])
+        self.assertTrue('bogus' in _check_args({'src': 'a', 'bogus': 1})[1])
+        self.assertTrue('order' in _check_args({'src': 'a', 'order': 'random'})[1])
+
+    def test_runs_in_process_only_on_local_connection(self):
+        class Stub(object):
+            pass
+        action = ActionModule.__new__(ActionModule)
+        action._task = Stub()
+        action._task.args = {'src': '/nonexistent/a.conf', 'dest': '/nonexistent/b.conf'}
+        action._task.async_val = 0
+        action._task.check_mode = False
+        action._play_context = Stub()
+        action._play_context.check_mode = False
+        action._play_context.become = False
+        action._connection = Stub()
+        action._connection.has_native_async = False
+        action._connection._shell = Stub()
+        action._connection._shell.tmpdir = None
+        action._remove_tmp_path = lambda tmpdir: None
+        action._execute_module = lambda module_args, task_vars, wrap_async: {
+            'remote': module_args, 'async': wrap_async}
+        for connection in ('ssh', 'paramiko', 'network_cli'):
+            action._play_context.connection = connection
+            self.assertEqual(action.run(task_vars={}),
+                             {'remote': action._task.args, 'async': 0}, connection)
+        for connection in ('local', 'ansible.builtin.local'):
+            action._play_context.connection = connection
+            self.assertTrue('remote' not in action.run(task_vars={}), connection)
+        action._play_context.become = True
+        self.assertTrue('remote' in action.run(task_vars={}), 'become')
+        action._play_context.become = False
+        action._task.async_val = 60
+        self.assertTrue(action.run(task_vars={})['async'], 'async')
+        action._task.async_val = 0
+        action._task.args = dict(action._task.args, remote_src=True)
+        self.assertEqual(action.run(task_vars={})['remote']['dest'], '/nonexistent/b.conf', '')
+
+class FilterTestCase(unittest.TestCase):
+
+    def test_shared_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        shared = os.path.join(tmpdir, 'config_sort')
+        shared_dir = configsort_filter._shared_dir
+        configsort_filter._shared_dir = lambda: shared
+        loader = configsort_filter._configsort
+        sort_config = configsort.sort_config
+        try:
+            text = 'router shared\n  b\n  a\n'
+            self.assertEqual(configsort_filter.config_sort(text), 'router shared\n  a\n  b\n', '')
+            self.assertEqual(configsort_filter.config_sort(['b', 'a']), ['a', 'b'], '')
+            ## The first worker to sort a config only leaves a marker.
+            self.assertTrue(all(f.endswith('.seen') for f in os.listdir(shared)), '')
+            ## The second one to sort it shares the result.
+            configsort_filter._cache.clear()
+            self.assertEqual(configsort_filter.config_sort(text), 'router shared\n  a\n  b\n', '')
+            self.assertEqual(configsort_filter.config_sort(['b', 'a']), ['a', 'b'], '')
+            self.assertEqual(len(os.listdir(shared)), 4, '')
+            ## After that, other workers don't sort it again.
+            configsort_filter._cache.clear()
+            configsort.sort_config = None
+            configsort_filter._configsort = lambda: configsort
+            self.assertEqual(configsort_filter.config_sort(text), 'router shared\n  a\n  b\n', '')
+            self.assertEqual(configsort_filter.config_sort(['b', 'a']), ['a', 'b'], '')
+        finally:
+            configsort.sort_config = sort_config
+            configsort_filter._configsort = loader
+            configsort_filter._shared_dir = shared_dir
+            shutil.rmtree(tmpdir)
+
+    def test_shared_cache_evicts_least_recently_used(self):
+        tmpdir = tempfile.mkdtemp()
+        shared = os.path.join(tmpdir, 'config_sort')
+        shared_dir = configsort_filter._shared_dir
+        configsort_filter._shared_dir = lambda: shared
+        try:
+            for n in range(configsort_filter.SHARED_SIZE - 2):
+                configsort_filter._save_shared('%d.json' % n, ['line %d' % n])
+            configsort_filter._save_shared('hot.json', ['hot'])
+            configsort_filter._save_shared('hot.json', ['hot'])
+            for name in os.listdir(shared):
+                os.utime(os.path.join(shared, name), (0, 0))
+            self.assertEqual(configsort_filter._load_shared('hot.json'), ['hot'], '')
+            configsort_filter._save_shared('new.json', ['new'])
+            names = os.listdir(shared)
+            self.assertEqual(len(names), configsort_filter.SHARED_KEEP + 1, '')
+            self.assertTrue('hot.json' in names and 'new.json.seen' in names, '')
+        finally:
+            configsort_filter._shared_dir = shared_dir
+            shutil.rmtree(tmpdir)
+
+    def test_loads_the_module_on_its_own(self):
+        loaded = sys.modules.pop(configsort_filter._MODULE_NAME, None)
+        try:
+            module = configsort_filter._configsort()
+            self.assertEqual(os.path.realpath(module.__file__),
+                             os.path.realpath(configsort.__file__.replace('.pyc', '.py')), '')
+            ## The action plugin reuses the same copy.
+            self.assertTrue(configsort_action._configsort() is module, '')
+        finally:
+            if loaded is not None:
+                sys.modules[configsort_filter._MODULE_NAME] = loaded
+
+    def test_text_and_lines(self):
+        text = 'interface eth 2\n  shutdown\ninterface eth 10\n'
+        self.assertEqual(configsort_filter.config_sort(text),
+                         'interface eth 10\ninterface eth 2\n  shutdown\n', '')
+        self.assertEqual(configsort_filter.config_sort(text.rstrip('\n'), 'natural'),
+                         'interface eth 2\n  shutdown\ninterface eth 10', '')
+        self.assertEqual(configsort_filter.config_sort(text.splitlines()),
+                         ['interface eth 10', 'interface eth 2', '  shutdown'], '')
+        ## e.g. lines|map('trim')|config_sort passes a generator.
+        self.assertEqual(configsort_filter.config_sort(line for line in text.splitlines()),
+                         ['interface eth 10', 'interface eth 2', '  shutdown'], '')
+
+    def test_cache(self):
+        lines = ['b', 'a']
+        first = configsort_filter.config_sort(lines)
+        first.append('changed')
+        self.assertEqual(configsort_filter.config_sort(lines), ['a', 'b'], '')
+        for n in range(configsort_filter.CACHE_SIZE + 1):
+            configsort_filter.config_sort(['line %d' % n])
+        self.assertEqual(len(configsort_filter._cache), configsort_filter.CACHE_SIZE, '')
+        self.assertRaises(configsort_filter.errors.AnsibleFilterError,
+                          configsort_filter.config_sort, lines, 'random')
+
 if __name__ == '__main__':
     unittest.main()
 
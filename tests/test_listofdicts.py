@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import
+
+import unittest
+from ansible import errors
+from filter_plugins.listofdicts import merge, merge_many, pluck, group_by, index_by
+
+class MergeTestCase(unittest.TestCase):
+
+    def test_merge_list(self):
+        interfaces = [
+            {'label': 'uplinks', 'mtu': 'jumbo'},
+            {'label': 'peerlinks', 'mtu': 'standard'},
+            {'label': 'unused'},
+            {'name': 'lo0'},
+        ]
+        int_defs = [
+            {'name': 'xe-0/1/0', 'label': 'uplinks'},
+            {'name': 'ge-0/0/0', 'label': 'peerlinks'},
+            {'name': 'xe-0/1/2', 'label': 'uplinks'},
+            {'name': 'ge-0/0/9', 'label': 'spare'},
+            {'name': 'ge-0/0/9', 'label': 'spare'},
+        ]
+        self.assertEqual(merge(interfaces, int_defs, 'label'), [
+            {'name': 'xe-0/1/0', 'label': 'uplinks', 'mtu': 'jumbo'},
+            {'name': 'xe-0/1/2', 'label': 'uplinks', 'mtu': 'jumbo'},
+            {'name': 'ge-0/0/0', 'label': 'peerlinks', 'mtu': 'standard'},
+            {'label': 'unused'},
+            {'name': 'lo0'},
+            {'name': 'ge-0/0/9', 'label': 'spare'},
+            {'name': 'ge-0/0/9', 'label': 'spare'},
+        ], '')
+        self.assertEqual(len(merge(interfaces, int_defs, 'label', filter=True)), 4, '')
+
+    def test_merge_dict(self):
+        interfaces = [{'label': 'uplinks', 'mtu': 'jumbo'}]
+        int_defs = {'uplinks': [{'name': 'xe-0/1/0'}], 'peerlinks': [{'name': 'ge-0/0/0'}]}
+        self.assertEqual(merge(interfaces, int_defs, 'label'), [
+            {'name': 'xe-0/1/0', 'label': 'uplinks', 'mtu': 'jumbo'},
+            {'name': 'ge-0/0/0', 'label': 'peerlinks'},
+        ], '')
+
+    def test_unhashable_labels(self):
+        stuff = [{'vlans': [1, 2], 'name': 'trunk'}]
+        data = [{'vlans': [1, 2], 'mode': 'tagged'}, {'vlans': [3]}]
+        self.assertEqual(merge(stuff, data, 'vlans', filter=True),
+                         [{'vlans': [1, 2], 'name': 'trunk', 'mode': 'tagged'}], '')
+
+class MergeManyTestCase(unittest.TestCase):
+
+    def test_matches_chained_merge(self):
+        interfaces = [{'label': 'uplinks', 'mtu': 'jumbo'}, {'label': 'peerlinks'}, {'mtu': 1500}]
+        int_defs = {'uplinks': [{'name': 'xe-0/1/0'}, {'name': 'xe-0/1/2'}],
+                    'peerlinks': [{'name': 'ge-0/0/0'}], 'spare': [{'name': 'ge-0/0/9'}]}
+        int_config = [{'name': 'xe-0/1/0', 'ipv4': '1.1.1.1/24'},
+                      {'name': 'xe-0/1/2', 'ipv4': '2.2.2.2/24'},
+                      {'name': 'lo0', 'ipv4': '10.0.0.1/32'}]
+        chained = merge(merge(interfaces, int_defs, 'label'), int_config, 'name')
+        self.assertEqual(merge_many(interfaces, [[int_defs, 'label'], [int_config, 'name']]), chained, '')
+        self.assertEqual(merge_many(interfaces, [[int_defs, 'label', True], [int_config, 'name', True]]),
+                         merge(merge(interfaces, int_defs, 'label', True), int_config, 'name', True), '')
+        self.assertEqual(interfaces[0], {'label': 'uplinks', 'mtu': 'jumbo'}, '')
+
+class GroupByTestCase(unittest.TestCase):
+
+    ports = [
+        {'name': 'ge-0/0/0', 'vlan': 10, 'mode': 'access'},
+        {'name': 'ge-0/0/1', 'vlan': 20, 'mode': 'access'},
+        {'name': 'ge-0/0/2', 'vlan': 10, 'mode': 'trunk'},
+        {'name': 'lo0'},
+    ]
+
+    def test_group_by(self):
+        groups = group_by(self.ports, 'vlan')
+        self.assertEqual(sorted(groups), [10, 20], '')
+        for vlan in groups:
+            self.assertEqual(groups[vlan], pluck(self.ports, 'vlan', vlan), '')
+        self.assertEqual(sorted(group_by(self.ports, ['vlan', 'mode'])),
+                         [(10, 'access'), (10, 'trunk'), (20, 'access')], '')
+        self.assertEqual(group_by(self.ports, ['vlan', 'mode'], '/')['10/trunk'], [self.ports[2]], '')
+        peers = [{'pair': ('a', 'b'), 'vrf': 'mgmt'}]
+        self.assertEqual(list(group_by(peers, ['pair', 'vrf'], '/')), ["('a', 'b')/mgmt"], '')
+
+    def test_index_by(self):
+        self.assertEqual(index_by(self.ports, 'name')['lo0'], self.ports[3], '')
+        self.assertEqual(index_by(self.ports, ['vlan', 'mode'])[(20, 'access')], self.ports[1], '')
+        self.assertRaises(errors.AnsibleFilterError, index_by, self.ports, 'vlan')
+        self.assertRaises(errors.AnsibleFilterError, group_by, [{'vlans': [1, 2]}], 'vlans')
+
+if __name__ == '__main__':
+    unittest.main()